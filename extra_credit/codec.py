@@ -0,0 +1,842 @@
+#!/bin/env python
+# posting list codecs shared by index.py and query.py. Every codec turns a
+# list of doc id gaps into bytes and back; the name of the codec an index was
+# built with is stored in the header of every posting file, so query.py picks
+# the matching decoder by itself.
+import binascii
+import struct
+import math
+from itertools import groupby
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Convert docIDs to docDeltas, counting from 'last'
+def to_gaps(arr, last = 0):
+  res = []
+  for n in arr:
+    res.append(n - last)
+    last = n
+  return res
+
+# Convert docDeltas to docIDs, counting from 'last'
+def from_gaps(arr, last = 0):
+  res = []
+  for gap in arr:
+    res.append(last + gap)
+    last += gap
+  return res
+
+
+# bit level output, codes are packed most significant bit first and the last
+# byte is padded with zero bits
+class BitWriter(object):
+  def __init__(self):
+    self.bytes = bytearray()
+    self.acc = 0
+    self.bits = 0
+
+  def write(self, value, length):
+    self.acc = (self.acc << length) | value
+    self.bits += length
+    while self.bits >= 8:
+      self.bits -= 8
+      self.bytes.append(self.acc >> self.bits)
+      self.acc &= (1 << self.bits) - 1
+
+  # unary code of num: num one bits and a zero
+  def write_unary(self, num):
+    self.write(((1 << num) - 1) << 1, num + 1)
+
+  def getvalue(self):
+    if self.bits > 0:
+      return self.bytes + bytearray([(self.acc << (8 - self.bits)) & 255])
+    return self.bytes
+
+# number of leading one bits of every byte value
+leading_ones = []
+for b in range(256):
+  count = 0
+  while count < 8 and b & (128 >> count):
+    count += 1
+  leading_ones.append(count)
+
+# bit level input over a bytearray
+class BitReader(object):
+  def __init__(self, data, pos = 0):
+    self.data = data
+    self.pos = pos
+
+  # unary code, counted a byte at a time through the leading_ones table
+  def read_unary(self):
+    num = 0
+    while True:
+      bit = self.pos & 7
+      run = leading_ones[(self.data[self.pos >> 3] << bit) & 255]
+      if run < 8 - bit:
+        self.pos += run + 1
+        return num + run
+      num += 8 - bit
+      self.pos += 8 - bit
+
+  # the next 'length' bits as a number, cut out of the bytes they span
+  def read(self, length):
+    if length == 0:
+      return 0
+    first = self.pos >> 3
+    last = (self.pos + length - 1) >> 3
+    acc = self.data[first]
+    for i in range(first + 1, last + 1):
+      acc = (acc << 8) | self.data[i]
+    acc >>= 8 * (last + 1) - self.pos - length
+    self.pos += length
+    return acc & ((1 << length) - 1)
+
+
+# variable byte code, seven bits per byte with the high bit set on the last
+# byte of every number
+def vb_encode_num(num):
+  bytes = []
+  while True:
+    bytes = [num % 128] + bytes
+    if num < 128:
+      break
+    num /= 128
+  bytes[len(bytes)-1] += 128
+  return bytes
+
+def vb_encode(arr):
+  bytestream = bytearray()
+  for n in arr:
+    bytestream.extend(vb_encode_num(n))
+  return bytestream
+
+# long lists are decoded in bulk with numpy when it is available: terminator
+# bytes are found with a mask, every 7 bit group is shifted into place and the
+# groups are summed per number
+vb_bulk_min = 64
+
+def vb_decode(bytes, count = -1):
+  if numpy is not None and len(bytes) >= vb_bulk_min:
+    data = numpy.frombuffer(bytes, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data >= 128)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    number = numpy.repeat(numpy.arange(len(ends)), ends - starts + 1)
+    shift = 7 * (ends[number] - numpy.arange(len(data)))
+    groups = numpy.left_shift((data & 127).astype(numpy.int64), shift)
+    return numpy.add.reduceat(groups, starts).tolist()
+  numbers = []
+  num = 0
+  for item in bytes:
+    if item < 128:
+      num = 128 * num + item
+    else:
+      numbers.append(128 * num + (item-128))
+      num = 0
+  return numbers
+
+
+# Elias gamma code of num + 2: the length L of num + 2 without its leading one
+# bit in unary (L ones and a zero), then those L bits
+def gamma_encode_num(num):
+  num += 2
+  length = num.bit_length() - 1
+  return ((1 << length) - 1) << (length + 1) | (num ^ (1 << length)), 2 * length + 1
+
+def gamma_encode(arr):
+  out = BitWriter()
+  for item in arr:
+    code, length = gamma_encode_num(item)
+    out.write(code, length)
+  return out.getvalue()
+
+def gamma_decode(lst, count = -1):
+  numbers = []
+  bits = BitReader(lst)
+  end = 8 * len(lst)
+  while len(numbers) != count and bits.pos < end:
+    length = bits.read_unary()
+    if length == 0:
+      # a zero without a unary prefix is padding
+      break
+    numbers.append(((1 << length) | bits.read(length)) - 2)
+  return numbers
+
+
+# Elias delta code of num + 1: the bit length L of num + 1 gamma coded (its
+# length without the leading one bit in unary, then those bits), followed by
+# num + 1 without its leading one bit
+def delta_encode(arr):
+  out = BitWriter()
+  for item in arr:
+    num = item + 1
+    length = num.bit_length()
+    length_bits = length.bit_length() - 1
+    out.write_unary(length_bits)
+    out.write(length ^ (1 << length_bits), length_bits)
+    out.write(num ^ (1 << (length - 1)), length - 1)
+  return out.getvalue()
+
+def delta_decode(lst, count):
+  numbers = []
+  bits = BitReader(lst)
+  for i in range(count):
+    length_bits = bits.read_unary()
+    length = (1 << length_bits) | bits.read(length_bits)
+    numbers.append(((1 << (length - 1)) | bits.read(length - 1)) - 1)
+  return numbers
+
+
+# Golomb-Rice code with parameter k picked per list from the mean gap and
+# stored in the first byte: num >> k in unary, then the low k bits of num
+def rice_encode(arr):
+  k = 0
+  if len(arr) > 0:
+    k = max(0, (sum(arr) / len(arr)).bit_length() - 1)
+  out = BitWriter()
+  out.write(k, 8)
+  for num in arr:
+    out.write_unary(num >> k)
+    out.write(num & ((1 << k) - 1), k)
+  return out.getvalue()
+
+def rice_decode(lst, count):
+  numbers = []
+  bits = BitReader(lst, 8)
+  k = lst[0]
+  for i in range(count):
+    q = bits.read_unary()
+    numbers.append((q << k) | bits.read(k))
+  return numbers
+
+
+# pack 'arr' into 'width' bit slots as one big number and back, which lets
+# python shift whole blocks of numbers at once
+def pack_bits(arr, width):
+  if width == 0:
+    return bytearray()
+  acc = 0
+  for num in reversed(arr):
+    acc = (acc << width) | num
+  nbytes = (len(arr) * width + 7) / 8
+  hex = '%x' % acc
+  hex = '0' * (2 * nbytes - len(hex)) + hex
+  return bytearray(binascii.unhexlify(hex))
+
+def unpack_bits(data, width, count):
+  if width == 0:
+    return [0] * count
+  acc = int(binascii.hexlify(data), 16) if len(data) > 0 else 0
+  mask = (1 << width) - 1
+  return [(acc >> (i * width)) & mask for i in range(count)]
+
+# PForDelta: blocks of pfor_block numbers, each packed with the bit width
+# that fits pfor_fit of them. The rest are exceptions whose high bits are
+# patched in afterwards. A block is its width, the exception count, the
+# packed low bits and then position gap / high bits pairs, all vb coded
+pfor_block = 128
+pfor_fit = 0.9
+
+def pfor_encode(arr):
+  bytestream = bytearray()
+  for i in range(0, len(arr), pfor_block):
+    block = arr[i:i+pfor_block]
+    widths = sorted([num.bit_length() for num in block])
+    width = widths[min(len(widths) - 1, int(len(widths) * pfor_fit))]
+    mask = (1 << width) - 1
+    exceptions = []
+    last = 0
+    for pos, num in enumerate(block):
+      if num >> width:
+        exceptions.extend((pos - last, num >> width))
+        last = pos
+    packed = pack_bits([num & mask for num in block], width)
+    bytestream.extend(vb_encode([width, len(exceptions) / 2]))
+    bytestream.extend(packed)
+    bytestream.extend(vb_encode(exceptions))
+  return bytestream
+
+# one vb coded number starting at 'pos', returns it and the position after it
+def vb_read(lst, pos):
+  num = 0
+  while lst[pos] < 128:
+    num = 128 * num + lst[pos]
+    pos += 1
+  return 128 * num + (lst[pos] - 128), pos + 1
+
+def pfor_decode(lst, count):
+  numbers = []
+  pos = 0
+  while len(numbers) < count:
+    n = min(pfor_block, count - len(numbers))
+    width, pos = vb_read(lst, pos)
+    num_exceptions, pos = vb_read(lst, pos)
+    nbytes = (n * width + 7) / 8
+    block = unpack_bits(lst[pos:pos+nbytes], width, n)
+    pos += nbytes
+    slot = 0
+    for i in range(num_exceptions):
+      gap, pos = vb_read(lst, pos)
+      high, pos = vb_read(lst, pos)
+      slot += gap
+      block[slot] |= high << width
+    numbers.extend(block)
+  return numbers
+
+
+# Simple-8b: 64 bit words holding a 4 bit selector and 60 bits of payload, the
+# selector says how many numbers of how many bits the payload packs. The last
+# word may be padded with zeros, the decoder stops after 'count' numbers
+simple8b_selectors = [(240, 0), (120, 0), (60, 1), (30, 2), (20, 3), (15, 4),
+  (12, 5), (10, 6), (8, 7), (7, 8), (6, 10), (5, 12), (4, 15), (3, 20),
+  (2, 30), (1, 60)]
+
+def simple8b_encode(arr):
+  words = []
+  i = 0
+  while i < len(arr):
+    for selector, (n, width) in enumerate(simple8b_selectors):
+      block = arr[i:i+n]
+      if max(block) >> width == 0:
+        break
+    word = selector << 60
+    for j, num in enumerate(block):
+      word |= num << (j * width)
+    words.append(word)
+    i += n
+  return bytearray(struct.pack('<%dQ' % len(words), *words))
+
+def simple8b_decode(lst, count):
+  numbers = []
+  for word in struct.unpack('<%dQ' % (len(lst) / 8), str(lst)):
+    n, width = simple8b_selectors[word >> 60]
+    if width == 0:
+      numbers.extend([0] * n)
+    else:
+      mask = (1 << width) - 1
+      numbers.extend([(word >> (j * width)) & mask for j in range(n)])
+  return numbers[:count]
+
+
+# codec name -> (encode, decode), decode is given the number of gaps to decode
+codecs = {
+  'vb': (vb_encode, vb_decode),
+  'gamma': (gamma_encode, gamma_decode),
+  'delta': (delta_encode, delta_decode),
+  'rice': (rice_encode, rice_decode),
+  'pfor': (pfor_encode, pfor_decode),
+  'simple8b': (simple8b_encode, simple8b_decode),
+}
+
+
+# every posting file starts with a magic and the name of its codec
+header_format = '<4s16s'
+header_size = struct.calcsize(header_format)
+
+def pack_header(codec):
+  return struct.pack(header_format, 'PIDX', codec)
+
+def unpack_header(buf):
+  magic, codec = struct.unpack_from(header_format, buf, 0)
+  if magic != 'PIDX' or codec.rstrip('\0') not in codecs:
+    raise ValueError('not a posting file')
+  return codec.rstrip('\0')
+
+
+# every list is stored in one of three layouts, named by a one byte tag in its
+# header. Lists of at most inline_max_df postings are inline: variable byte
+# coded gaps, without skip table and whatever header the codec adds. Lists
+# holding more than one in bitmap_ratio of all documents are bitmaps with bit
+# d of byte d/8 set for doc d, which query.py can AND word by word. All other
+# lists are coded as gaps with the codec of the index and have skip pointers.
+# Indexes built with --roaring have roaring bitmaps instead of the last two
+list_inline = 0
+list_gaps = 1
+list_bitmap = 2
+list_roaring = 3
+inline_max_df = 2
+bitmap_ratio = 8
+
+def list_tag(df, num_docs, roaring = False):
+  if df <= inline_max_df:
+    return list_inline
+  if roaring:
+    return list_roaring
+  if df * bitmap_ratio > num_docs:
+    return list_bitmap
+  return list_gaps
+
+# a postings list is stored as a header of word id, doc freq and layout tag,
+# then the lengths of the skip table and of the encoded doc ids, followed by
+# those two. Only gaps lists have a skip table, inline lists a one byte length
+record_format = '=IIB'
+record_size = struct.calcsize(record_format)
+length_formats = {list_inline: '=B', list_gaps: '=II', list_bitmap: '=I', list_roaring: '=I'}
+
+def pack_lengths(tag, skip_length, length):
+  if tag == list_gaps:
+    return struct.pack(length_formats[tag], skip_length, length)
+  return struct.pack(length_formats[tag], length)
+
+# the skip table and doc id lengths stored at 'pos'
+def unpack_lengths(tag, buf, pos = 0):
+  if tag == list_gaps:
+    return struct.unpack_from(length_formats[tag], buf, pos)
+  return (0,) + struct.unpack_from(length_formats[tag], buf, pos)
+
+# doc ids of the set bits of a bitmap, through a table of the set bits of
+# every byte value or with numpy when it is available
+byte_bits = [[bit for bit in range(8) if value >> bit & 1] for value in range(256)]
+
+def bitmap_docs(bitmap):
+  if numpy is not None and len(bitmap) >= vb_bulk_min:
+    # unpackbits gives the high bit of a byte first, the bits of every byte
+    # are reversed here as the bitorder argument needs numpy 1.17, which no
+    # longer runs on Python 2
+    data = numpy.frombuffer(bitmap, dtype=numpy.uint8).reshape(-1, 1)
+    bits = numpy.unpackbits(data, axis=1)[:, ::-1].ravel()
+    return numpy.flatnonzero(bits).tolist()
+  docs = []
+  for i, value in enumerate(bitmap):
+    if value:
+      docs.extend([8 * i + bit for bit in byte_bits[value]])
+  return docs
+
+# bitmaps are ANDed as python longs, which works a machine word at a time.
+# Bit d of the long is doc d, so the bytes are read in reverse
+def bitmap_value(bitmap):
+  return long(binascii.hexlify(bitmap[::-1]), 16)
+
+def value_docs(value):
+  digits = '%x' % value
+  return bitmap_docs(bytearray(binascii.unhexlify('0' * (len(digits) % 2) + digits)[::-1]))
+
+# skip pointers: lists of at least skip_min_df postings are cut into segments
+# of sqrt(df) postings, each encoded on its own. For every segment but the
+# first the skip table holds the doc id just before the segment and the byte
+# offset of the segment in the encoded doc ids, both vb coded as gaps
+skip_min_df = 16
+
+def skip_step(df):
+  if df < skip_min_df:
+    return df
+  return int(math.sqrt(df))
+
+# lists are streamed when written and when read by index.py, which never
+# holds a whole list in memory: doc ids go one skip segment, bitmap chunk or
+# roaring container at a time. stream_chunk is the number of doc ids, or of
+# bytes of a bitmap, handled at a time
+stream_chunk = 64 * 1024
+
+# cut an iterable into lists of 'size' items
+def chunked(iterable, size):
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+# write the doc ids in 'docs' to 'out' one segment at a time, returns the
+# skip table
+def write_gaps(codec, out, docs, step):
+  encode = codecs[codec][0]
+  bases = []
+  offsets = []
+  last = 0
+  offset = 0
+  for segment in chunked(docs, step):
+    if offset > 0:
+      bases.append(last)
+      offsets.append(offset)
+    content = encode(to_gaps(segment, last))
+    out.write(content)
+    offset += len(content)
+    last = segment[-1]
+  return skip_table(bases, offsets)
+
+def skip_table(bases, offsets):
+  skips = []
+  for base, offset in zip(to_gaps(bases), to_gaps(offsets)):
+    skips.extend((base, offset))
+  return vb_encode(skips)
+
+# write the bitmap of the doc ids in 'docs' to 'out' one chunk at a time. The
+# last byte of a chunk may still get bits from the next one, so it is carried
+# over and written with it
+def write_bitmap(out, docs):
+  start = 0
+  carry = 0
+  for chunk in chunked(docs, stream_chunk):
+    bitmap = bytearray((chunk[-1] >> 3) - start + 1)
+    bitmap[0] |= carry
+    for doc in chunk:
+      bitmap[(doc >> 3) - start] |= 1 << (doc & 7)
+    out.write(bitmap[:-1])
+    start = chunk[-1] >> 3
+    carry = bitmap[-1]
+  out.write(chr(carry))
+
+# the doc ids preceding each segment and the offsets of the segments, both
+# including the first segment
+def decode_skips(skip_data):
+  skips = vb_decode(skip_data)
+  return [0] + from_gaps(skips[0::2]), [0] + from_gaps(skips[1::2])
+
+# decode the 'count' doc ids of one segment following doc id 'base'
+def decode_segment(codec, data, base, count):
+  return from_gaps(codecs[codec][1](data, count), base)
+
+# decode all doc ids of a list
+def decode_posting(codec, df, skip_data, data):
+  bases, offsets = decode_skips(skip_data)
+  ends = offsets[1:] + [len(data)]
+  step = skip_step(df)
+  docs = []
+  for k in range(len(bases)):
+    count = min(step, df - k * step)
+    docs.extend(decode_segment(codec, data[offsets[k]:ends[k]], bases[k], count))
+  return docs
+
+# roaring bitmaps: doc ids are split into chunks of 2^16 by their high 16
+# bits. A chunk of at most roaring_array_max doc ids is an array container of
+# their low 16 bits, a fuller one a bitmap container of 2^16 bits. The list is
+# the number of containers and a directory with the key, the cardinality
+# minus one and the offset of every container, followed by the containers
+roaring_array_max = 4096
+roaring_bitmap_size = 8192
+roaring_entry = '<HHI'
+
+# write the containers of the doc ids in 'docs' to 'out' one chunk at a time,
+# returns the directory that goes before them
+def write_roaring(out, docs):
+  entries = []
+  offset = 0
+  for key, chunk in groupby(docs, lambda doc: doc >> 16):
+    lows = [doc & 0xffff for doc in chunk]
+    entries.append(struct.pack(roaring_entry, key, len(lows) - 1, offset))
+    container = roaring_container(lows)
+    out.write(container)
+    offset += len(container)
+  return bytearray(struct.pack('<I', len(entries)) + ''.join(entries))
+
+def roaring_container(lows):
+  if len(lows) <= roaring_array_max:
+    return struct.pack('<%dH' % len(lows), *lows)
+  container = bytearray(roaring_bitmap_size)
+  for low in lows:
+    container[low >> 3] |= 1 << (low & 7)
+  return container
+
+# directory of the roaring bitmap at 'pos' and the position of its containers
+def roaring_directory(buf, pos):
+  count = struct.unpack_from('<I', buf, pos)[0]
+  size = struct.calcsize(roaring_entry)
+  entries = [struct.unpack_from(roaring_entry, buf, pos + 4 + size * i) for i in range(count)]
+  return entries, pos + 4 + size * count
+
+# the same, read from 'pos' of a file
+def read_directory(file, pos):
+  file.seek(pos)
+  count = struct.unpack('<I', file.read(4))[0]
+  entries, start = roaring_directory(struct.pack('<I', count) + file.read(struct.calcsize(roaring_entry) * count), 0)
+  return entries, pos + start
+
+# bytes taken by a container of cardinality 'card' + 1
+def container_size(card):
+  if card < roaring_array_max:
+    return 2 * (card + 1)
+  return roaring_bitmap_size
+
+# the low bits of the container of cardinality 'card' + 1 at 'pos' of a file
+def read_container(file, pos, card):
+  file.seek(pos)
+  data = file.read(container_size(card))
+  if card < roaring_array_max:
+    return list(struct.unpack('<%dH' % (card + 1), data))
+  return bitmap_docs(bytearray(data))
+
+# all containers of the roaring bitmap at 'pos' as (key, container) pairs,
+# array containers are lists of the low bits and bitmap containers longs
+def read_containers(buf, pos):
+  entries, start = roaring_directory(buf, pos)
+  containers = []
+  for key, card, offset in entries:
+    if card < roaring_array_max:
+      containers.append((key, list(struct.unpack_from('<%dH' % (card + 1), buf, start + offset))))
+    else:
+      containers.append((key, bitmap_value(buf[start+offset:start+offset+roaring_bitmap_size])))
+  return containers
+
+def container_docs(containers):
+  docs = []
+  for key, c in containers:
+    if not isinstance(c, list):
+      c = value_docs(c)
+    docs.extend([(key << 16) + low for low in c])
+  return docs
+
+# write the 'df' doc ids coming in order from 'docs' to 'out' in layout 'tag',
+# returns the skip table of a gaps list and the directory of a roaring one,
+# which go before the doc ids
+def write_list(codec, out, tag, df, docs):
+  if tag == list_inline:
+    out.write(vb_encode(to_gaps(list(docs))))
+  elif tag == list_bitmap:
+    write_bitmap(out, docs)
+  elif tag == list_roaring:
+    return bytearray(), write_roaring(out, docs)
+  else:
+    return write_gaps(codec, out, docs, skip_step(df)), bytearray()
+  return bytearray(), bytearray()
+
+# the doc ids of the list in layout 'tag' whose skip table starts at 'pos' of
+# 'file', read and decoded one skip segment, bitmap chunk or roaring container
+# at a time. Every read seeks first, so several lists of a file can be streamed
+def stream_list(codec, file, tag, df, pos, skip_length, length):
+  file.seek(pos)
+  if tag == list_inline:
+    for doc in from_gaps(vb_decode(bytearray(file.read(length)))):
+      yield doc
+  elif tag == list_bitmap:
+    for start in range(0, length, stream_chunk):
+      file.seek(pos + start)
+      for doc in bitmap_docs(bytearray(file.read(min(stream_chunk, length - start)))):
+        yield 8 * start + doc
+  elif tag == list_roaring:
+    entries, start = read_directory(file, pos)
+    for key, card, offset in entries:
+      for low in read_container(file, start + offset, card):
+        yield (key << 16) + low
+  else:
+    bases, offsets = decode_skips(bytearray(file.read(skip_length)))
+    ends = offsets[1:] + [length]
+    step = skip_step(df)
+    for k in range(len(bases)):
+      file.seek(pos + skip_length + offsets[k])
+      data = bytearray(file.read(ends[k] - offsets[k]))
+      for doc in decode_segment(codec, data, bases[k], min(step, df - k * step)):
+        yield doc
+
+# merge fast path: lists of a term covering disjoint doc id ranges, all doc ids
+# of one list below those of the next, are joined as they are stored. Gaps are
+# copied with only the first gap of every list re-encoded and the skip table
+# rebuilt from the decoded segment bounds, which needs a codec coding every
+# gap in whole bytes of its own so segments can be cut at any gap. Bitmaps are
+# ORed over the one byte two of them can share and roaring containers copied
+# with only a chunk shared by two lists re-encoded. The result is the same as
+# encoding the merged doc ids
+byte_aligned = ['vb']
+
+# copy 'length' bytes at 'pos' of 'src' to 'out'
+def copy_bytes(src, pos, length, out):
+  src.seek(pos)
+  while length > 0:
+    buf = src.read(min(stream_chunk, length))
+    out.write(buf)
+    length -= len(buf)
+
+# end offsets of the vb coded numbers in 'bytes'
+def vb_ends(bytes):
+  if numpy is not None and len(bytes) >= vb_bulk_min:
+    return (numpy.flatnonzero(numpy.frombuffer(bytes, dtype=numpy.uint8) >= 128) + 1).tolist()
+  return [i + 1 for i, item in enumerate(bytes) if item >= 128]
+
+# the first and last doc ids of the list in layout 'tag' at 'pos' of 'file',
+# reading no more than its first and last segment or container
+def list_bounds(codec, file, tag, df, pos, skip_length, length):
+  if tag == list_inline:
+    docs = list(stream_list(codec, file, tag, df, pos, skip_length, length))
+    return docs[0], docs[-1]
+  if tag == list_gaps:
+    file.seek(pos)
+    bases, offsets = decode_skips(bytearray(file.read(skip_length)))
+    offsets.append(length)
+    step = skip_step(df)
+    file.seek(pos + skip_length)
+    first = decode_segment(codec, bytearray(file.read(offsets[1])), 0, min(step, df))[0]
+    file.seek(pos + skip_length + offsets[-2])
+    data = bytearray(file.read(length - offsets[-2]))
+    return first, decode_segment(codec, data, bases[-1], df - (len(bases) - 1) * step)[-1]
+  if tag == list_bitmap:
+    first = None
+    for start in range(0, length, stream_chunk):
+      file.seek(pos + start)
+      chunk = bytearray(file.read(min(stream_chunk, length - start)))
+      zeros = len(chunk) - len(chunk.lstrip('\0'))
+      if zeros < len(chunk):
+        first = 8 * (start + zeros) + byte_bits[chunk[zeros]][0]
+        break
+    file.seek(pos + length - 1)
+    return first, 8 * (length - 1) + byte_bits[ord(file.read(1))][-1]
+  entries, start = read_directory(file, pos)
+  key, card, offset = entries[0]
+  first = (key << 16) + read_container(file, start + offset, card)[0]
+  key, card, offset = entries[-1]
+  return first, (key << 16) + read_container(file, start + offset, card)[-1]
+
+# join the lists of 'refs', each a tuple of the arguments of stream_list
+# after the codec, in doc id order into 'out' in layout 'tag'. Returns the
+# skip table and the roaring directory like write_list
+def join_lists(codec, out, tag, refs, df):
+  if tag == list_bitmap:
+    join_bitmaps(out, refs)
+  elif tag == list_roaring:
+    return bytearray(), join_roaring(out, refs)
+  else:
+    return join_gaps(codec, out, refs, skip_step(df)), bytearray()
+  return bytearray(), bytearray()
+
+# gaps lists are decoded a segment at a time only to find the doc ids and
+# byte offsets at the new segment bounds
+def join_gaps(codec, out, refs, step):
+  encode = codecs[codec][0]
+  bases = []
+  offsets = []
+  count = 0
+  offset = 0
+  last = 0
+  for file, tag, df, pos, skip_length, length in refs:
+    file.seek(pos)
+    in_bases, in_offsets = decode_skips(bytearray(file.read(skip_length)))
+    in_offsets.append(length)
+    in_step = skip_step(df)
+    for k, base in enumerate(in_bases):
+      file.seek(pos + skip_length + in_offsets[k])
+      data = bytearray(file.read(in_offsets[k+1] - in_offsets[k]))
+      docs = decode_segment(codec, data, base, min(in_step, df - k * in_step))
+      ends = vb_ends(data)
+      if k == 0 and count > 0:
+        data = encode([docs[0] - last]) + data[ends[0]:]
+        ends = vb_ends(data)
+      bound = step * (len(bases) + 1)
+      while bound < count + len(docs):
+        i = bound - count
+        if i == 0:
+          bases.append(last)
+          offsets.append(offset)
+        else:
+          bases.append(docs[i-1])
+          offsets.append(offset + ends[i-1])
+        bound += step
+      out.write(data)
+      count += len(docs)
+      offset += len(data)
+      last = docs[-1]
+  return skip_table(bases, offsets)
+
+# a bitmap starts within or after the last byte of the one before it, whose
+# bytes come first, so only that byte is ORed and all bytes before it are zero
+def join_bitmaps(out, refs):
+  written = 0
+  carry = 0
+  for file, tag, df, pos, skip_length, length in refs:
+    file.seek(pos + written)
+    carry |= ord(file.read(1))
+    if length - written > 1:
+      out.write(chr(carry))
+      copy_bytes(file, pos + written + 1, length - written - 2, out)
+      carry = ord(file.read(1))
+    written = length - 1
+  out.write(chr(carry))
+
+# the last container of a roaring bitmap is held back decoded in case the next
+# one starts in the same chunk
+def join_roaring(out, refs):
+  entries = []
+  offset = 0
+  pending = None
+  for file, tag, df, pos, skip_length, length in refs:
+    in_entries, start = read_directory(file, pos)
+    for i, (key, card, in_offset) in enumerate(in_entries):
+      if pending is not None and pending[0] == key:
+        pending = (key, pending[1] + read_container(file, start + in_offset, card))
+        continue
+      if pending is not None:
+        container = roaring_container(pending[1])
+        entries.append(struct.pack(roaring_entry, pending[0], len(pending[1]) - 1, offset))
+        out.write(container)
+        offset += len(container)
+        pending = None
+      if i == len(in_entries) - 1:
+        pending = (key, read_container(file, start + in_offset, card))
+      else:
+        entries.append(struct.pack(roaring_entry, key, card, offset))
+        copy_bytes(file, start + in_offset, container_size(card), out)
+        offset += container_size(card)
+  container = roaring_container(pending[1])
+  entries.append(struct.pack(roaring_entry, pending[0], len(pending[1]) - 1, offset))
+  out.write(container)
+  return bytearray(struct.pack('<I', len(entries)) + ''.join(entries))
+
+def decode_list(codec, tag, df, skip_data, data):
+  if tag == list_inline:
+    return from_gaps(vb_decode(data))
+  if tag == list_bitmap:
+    return bitmap_docs(data)
+  if tag == list_roaring:
+    return container_docs(read_containers(data, 0))
+  return decode_posting(codec, df, skip_data, data)
+
+# positions: the positions of a term within its documents are cut into the
+# same segments as its doc ids. A segment holds the number of positions in
+# each of its documents, vb coded, followed by all of their positions as gaps
+# coded with the codec of the index, counting from 0 in every document. A
+# table with the number of segments and their byte offsets comes first.
+# write_position_list writes the segments of the positions coming one document
+# at a time from 'positions' to 'out' and returns the table
+def write_position_list(codec, out, df, positions):
+  encode = codecs[codec][0]
+  offsets = []
+  offset = 0
+  for segment in chunked(positions, skip_step(df)):
+    if offset > 0:
+      offsets.append(offset)
+    content = vb_encode([len(p) for p in segment])
+    gaps = []
+    for p in segment:
+      gaps.extend(to_gaps(p))
+    content.extend(encode(gaps))
+    out.write(content)
+    offset += len(content)
+  return vb_encode([len(offsets)] + to_gaps(offsets))
+
+# decode the positions of the 'count' documents of one segment
+def decode_position_segment(codec, data, count):
+  counts = []
+  pos = 0
+  for i in range(count):
+    num, pos = vb_read(data, pos)
+    counts.append(num)
+  gaps = codecs[codec][1](data[pos:], sum(counts))
+  positions = []
+  start = 0
+  for num in counts:
+    positions.append(from_gaps(gaps[start:start+num]))
+    start += num
+  return positions
+
+# the positions of the 'df' documents of the record of 'length' bytes at 'pos'
+# of 'file', one list per document, read and decoded one segment at a time.
+# The number of segments follows from df and a vb coded number takes at most
+# 5 bytes, which bounds the read of the table
+def stream_position_list(codec, file, df, pos, length):
+  step = skip_step(df)
+  segments = (df + step - 1) / step
+  file.seek(pos)
+  table = bytearray(file.read(min(length, 5 * segments)))
+  offsets = [0]
+  num, idx = vb_read(table, 0)
+  for i in range(num):
+    gap, idx = vb_read(table, idx)
+    offsets.append(offsets[-1] + gap)
+  ends = offsets[1:] + [length - idx]
+  for k in range(segments):
+    file.seek(pos + idx + offsets[k])
+    data = bytearray(file.read(ends[k] - offsets[k]))
+    for p in decode_position_segment(codec, data, min(step, df - k * step)):
+      yield p
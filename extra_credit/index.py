@@ -1,19 +1,106 @@
 #!/bin/env python
 from collections import deque
-from itertools import groupby
+from itertools import izip
+from array import array
 import struct
 import os, glob, os.path
+import getopt
+import multiprocessing
+import threading
+import Queue
+import heapq
+import tempfile
+import shutil
+import fcntl
+import time
 import sys
 import re
+from codec import codecs, pack_header, unpack_header, header_size, record_format, record_size, \
+  length_formats, pack_lengths, unpack_lengths, list_tag, write_list, stream_list, \
+  write_position_list, stream_position_list, list_inline, list_gaps, byte_aligned, \
+  list_bounds, join_lists, copy_bytes
 
 
-if len(sys.argv) != 3:
-  print >> sys.stderr, 'usage: python index.py data_dir output_dir' 
+def usage():
+  print >> sys.stderr, 'usage: python index.py [--fan-in=N] [--workers=N] [--block-mem=MB] [--sorted-ids] [--binary-dict] [--codec=NAME] [--roaring] [--positions] [--write-buffer=MB] [--writer-thread] [--append | --segment] [--compact] [--tier-width=N] data_dir output_dir'
+  print >> sys.stderr, '       python index.py --compact [--tier-width=N] [--fan-in=N] output_dir'
   os._exit(-1)
 
+try:
+  opts, args = getopt.gnu_getopt(sys.argv[1:], '', ['fan-in=', 'workers=', 'block-mem=', 'sorted-ids', 'binary-dict', 'codec=', 'roaring', 'positions', 'write-buffer=', 'writer-thread', 'append', 'segment', 'compact', 'tier-width='])
+except getopt.GetoptError:
+  usage()
+if len(args) != 2 and not (len(args) == 1 and ('--compact', '') in opts):
+  usage()
+
+# max number of blocks merged together in one merge pass
+merge_fan_in = 64
+# number of processes inverting blocks concurrently
+num_workers = 1
+# memory budget in bytes of a block under construction, per worker
+block_mem = 64 * 1024 * 1024
+# assign word ids in sorted term order instead of first-seen order
+sorted_word_ids = False
+# also write the dictionaries in the memory mappable binary format
+binary_dict = False
+# codec of the posting lists, one of the names in codec.codecs
+index_codec = 'gamma'
+# store the lists of all but the rarest terms as roaring bitmaps
+roaring = False
+# also keep the positions of every term within its documents
+positional = False
+# bytes of output collected in memory before they are written out
+write_buffer = 4 * 1024 * 1024
+# write output from a separate thread, overlapping it with the encoding
+writer_thread = False
+# add the new subdirectories of data_dir to the index already in output_dir
+append = False
+# add the new subdirectories of data_dir to output_dir as a new segment
+segment = False
+# merge segments of the same size tier, after adding a segment if data_dir is
+# given
+compact = False
+# number of segments of a tier that are merged together
+tier_width = 4
+for opt, val in opts:
+  if opt == '--fan-in':
+    merge_fan_in = int(val)
+  elif opt == '--workers':
+    num_workers = int(val)
+  elif opt == '--block-mem':
+    block_mem = int(float(val) * 1024 * 1024)
+  elif opt == '--sorted-ids':
+    sorted_word_ids = True
+  elif opt == '--binary-dict':
+    binary_dict = True
+  elif opt == '--codec':
+    index_codec = val
+  elif opt == '--roaring':
+    roaring = True
+  elif opt == '--positions':
+    positional = True
+  elif opt == '--write-buffer':
+    write_buffer = int(float(val) * 1024 * 1024)
+  elif opt == '--writer-thread':
+    writer_thread = True
+  elif opt == '--append':
+    append = True
+  elif opt == '--segment':
+    segment = True
+  elif opt == '--compact':
+    segment = True
+    compact = True
+  elif opt == '--tier-width':
+    tier_width = int(val)
+if merge_fan_in < 2 or num_workers < 1 or block_mem <= 0 or write_buffer <= 0 or index_codec not in codecs \
+  or tier_width < 2 or (append and segment):
+  usage()
+
 total_file_count = 0
-root = sys.argv[1]
-out_dir = sys.argv[2]
+root = None
+if len(args) == 2:
+  root = args[0]
+out_dir = args[-1]
 if not os.path.exists(out_dir):
   os.makedirs(out_dir)
 
@@ -24,102 +111,222 @@ posting_dict = {}
 doc_id_dict = {}
 # this is a dict holding word -> word_id
 word_dict = {}
+# word id -> position of its positions in corpus.positions
+position_dict = {}
 # this is a queue holding block names, later used for merging blocks
 block_q = deque([])
+# rough in-memory cost in bytes of a new term and of one posting of a block
+# under construction, used to decide when the block has to be flushed. The
+# postings of a term are kept in a packed array of unsigned ints
+term_cost = 200
+posting_cost = array('I').itemsize
+# this is a dict holding block name -> (posting offsets, word ids, positions
+# offsets), all indexed by the local term ids of blocks that have not been
+# merged yet. The positions offsets are None unless positions are kept
+block_lexicon = {}
+# number of documents in the collection, lists are laid out relative to it
+num_docs = 0
 
 
-# Convert docIDs to docDeltas
-def to_gaps(arr):
-  res = []
-  last = 0
-  for n in arr:
-    res.append(n - last)
-    last = n
-  return res
-
-# Convert docDeltas to docIDs
-def from_gaps(arr):
-  res = []
-  last = 0
-  for gap in arr:
-    res.append(last + gap)
-    last += gap
-  return res
-
-def gamma_encode_num(num):
-  num += 2
-  bstr = bin(num)[2:]
-  offset = bstr[1:]
-  return len(offset) * '1' + '0' + offset
-
-def gamma_encode(arr):
-  num = []
-  bytestream = ""
-  for item in arr:
-    bytestream += gamma_encode_num(item)
-  pad = (len(bytestream) / 8 + 1) * 8 - len(bytestream)
-  bytestream += pad * '0'
-  for i in range(0, len(bytestream), 8):
-    num.append(int(bytestream[i:i+8], 2))
-  return bytearray(num)
-    
-
-def gamma_decode(lst):
-  S = "".join([(8-len(bin(u)[2:])) * '0' + bin(u)[2:] for u in lst])
-  numbers = []
-  idx = 0
-  flag = True
-  num = "1"
-  count = 0
-  while True:
-    if idx >= len(S):
-      break
-    if flag:
-      if S[idx] == '1':
-        count += 1
-      elif count != 0:
-        flag = False
-      else:
-        break
-      idx += 1
+# output stage of the block and index files. Writes are collected in a buffer
+# of up to write_buffer bytes, the file is written write_chunk aligned chunks
+# at a time and positions are counted here instead of asking the file. With
+# --writer-thread the chunks go through a short queue to a thread writing
+# them, so encoding continues while the previous chunks hit the disk
+write_chunk = 64 * 1024
+
+class OutputFile(object):
+  def __init__(self, path, mode = 'wb'):
+    self.file = open(path, mode)
+    self.buf = bytearray()
+    self.pos = 0
+    self.queue = None
+    if writer_thread:
+      self.queue = Queue.Queue(4)
+      self.error = None
+      self.thread = threading.Thread(target = self.run)
+      self.thread.daemon = True
+      self.thread.start()
+
+  def tell(self):
+    return self.pos
+
+  def write(self, data):
+    self.buf.extend(data)
+    self.pos += len(data)
+    if len(self.buf) >= max(write_buffer, write_chunk):
+      size = len(self.buf) - len(self.buf) % write_chunk
+      self.emit(self.buf[:size])
+      del self.buf[:size]
+
+  def emit(self, data):
+    if self.queue is None:
+      self.file.write(data)
     else:
-      for i in range(count):
-        num += S[idx+i]
-      numbers.append(int(num, 2)-2)
-      num = "1"
-      idx = idx + count
-      flag = True
-      count = 0
-  return numbers
-
-# pull one list of postings from the file
-def read_posting(file):
-  buf = file.read(struct.calcsize("II"))
-  if len(buf) > 0:
-    term_id, length = struct.unpack("II", buf)
-    docID = bytearray(file.read(length))
-    posting = [term_id] + from_gaps(gamma_decode(docID))
-    return posting
-  else:
-    return []
-
-
-# push one list of postings to the file
-def print_posting(file, posting):
-  term_id = posting[0]
-  docID = posting[1:]
-  posting_dict[term_id] = (file.tell(), len(docID))
-  content = bytearray(gamma_encode(to_gaps(docID)))
-  file.write(struct.pack("II", term_id, len(content)))
-  file.write(content)
-
-# pop out postings
-def popLeftOrNone(p):
-  if len(p) > 0:
-    posting = p.popleft()
-  else:
-    posting = None
-  return posting
+      self.queue.put(data)
+
+  def run(self):
+    while True:
+      data = self.queue.get()
+      if data is None:
+        break
+      if self.error is None:
+        try:
+          self.file.write(data)
+        except IOError, e:
+          self.error = e
+
+  def close(self):
+    self.emit(self.buf)
+    self.buf = bytearray()
+    if self.queue is not None:
+      self.queue.put(None)
+      self.thread.join()
+      if self.error is not None:
+        raise self.error
+    self.file.close()
+
+# lists are streamed: merges never hold a whole list in memory. Doc ids are
+# read one skip segment, bitmap chunk or roaring container at a time and
+# encoded the same way into a spool, which stays in memory up to spool_mem
+# bytes and spills to a temporary file beyond. Only the skip table or roaring
+# directory, which go before the doc ids, are collected in full
+spool_mem = 1024 * 1024
+
+# push the list of the 'df' doc ids coming in order from 'docs' to the file in
+# the layout picked for its length: the header, then the skip table and then
+# the doc ids from the spool
+def write_posting(file, term_id, df, docs):
+  posting_dict[term_id] = (file.tell(), df)
+  tag = list_tag(df, num_docs, roaring)
+  spool = tempfile.SpooledTemporaryFile(spool_mem)
+  skips, directory = write_list(index_codec, spool, tag, df, docs)
+  file.write(struct.pack(record_format, term_id, df, tag))
+  write_spool(file, tag, skips, directory, spool)
+
+# the rest of a list after its header: the lengths, the skip table or roaring
+# directory and the doc ids encoded into 'spool'
+def write_spool(file, tag, skips, directory, spool):
+  file.write(pack_lengths(tag, len(skips), len(directory) + spool.tell()))
+  file.write(skips)
+  file.write(directory)
+  spool.seek(0)
+  shutil.copyfileobj(spool, file)
+  spool.close()
+
+# merge fast path: blocks never share a document, so the lists of a term often
+# cover disjoint doc id ranges. If they also have the layout of the merged list
+# they are joined as they are stored, see codec.join_lists, and a single list
+# is copied whole. Returns whether the lists were written
+def join_posting(file, term_id, df, refs):
+  tag = list_tag(df, num_docs, roaring)
+  if any([ref[1] != tag for ref in refs]):
+    return False
+  if len(refs) > 1:
+    if tag == list_inline or (tag == list_gaps and index_codec not in byte_aligned):
+      return False
+    bounds = sorted([list_bounds(index_codec, *ref) + (ref,) for ref in refs])
+    for prev, next in izip(bounds, bounds[1:]):
+      if prev[1] >= next[0]:
+        return False
+    refs = [b[2] for b in bounds]
+  posting_dict[term_id] = (file.tell(), df)
+  file.write(struct.pack(record_format, term_id, df, tag))
+  if len(refs) == 1:
+    src, tag, df, pos, skip_length, length = refs[0]
+    file.write(pack_lengths(tag, skip_length, length))
+    copy_bytes(src, pos, skip_length + length, file)
+    return True
+  spool = tempfile.SpooledTemporaryFile(spool_mem)
+  skips, directory = join_lists(index_codec, spool, tag, refs, df)
+  write_spool(file, tag, skips, directory, spool)
+  return True
+
+# pull the header of the next list from the file: its term id, its doc freq
+# and where to find it for stream_docs, which reads the doc ids lazily through
+# its own offsets. The file is left at the following list
+def next_posting(file):
+  buf = file.read(record_size)
+  if len(buf) == 0:
+    return None
+  term_id, df, tag = struct.unpack(record_format, buf)
+  skip_length, length = unpack_lengths(tag, file.read(struct.calcsize(length_formats[tag])))
+  pos = file.tell()
+  file.seek(pos + skip_length + length)
+  return term_id, df, (file, tag, df, pos, skip_length, length)
+
+# the doc ids of a list found by next_posting, see codec.stream_list
+def stream_docs(ref):
+  return stream_list(index_codec, *ref)
+
+# positions: with --positions the positions of every term within its
+# documents go to a separate stream next to each posting file, so queries
+# that do not need them never decode them. Every record is preceded by its
+# length, see codec.write_position_list for the layout. Like lists, positions
+# are streamed one segment at a time
+def write_positions(file, term_id, df, positions):
+  position_dict[term_id] = file.tell()
+  spool = tempfile.SpooledTemporaryFile(spool_mem)
+  table = write_position_list(index_codec, spool, df, positions)
+  file.write(struct.pack('=I', len(table) + spool.tell()))
+  file.write(table)
+  spool.seek(0)
+  shutil.copyfileobj(spool, file)
+  spool.close()
+
+# copy the positions record found by next_positions whole
+def copy_positions(file, term_id, ref):
+  position_dict[term_id] = file.tell()
+  src, df, pos, length = ref
+  copy_bytes(src, pos - 4, length + 4, file)
+
+# pull the length of the next positions record of a term with 'df' documents
+# from the file and return where to find it for stream_positions. The file is
+# left at the following record
+def next_positions(file, df):
+  length = struct.unpack('=I', file.read(4))[0]
+  pos = file.tell()
+  file.seek(pos + length)
+  return file, df, pos, length
+
+# the positions of the documents of a record found by next_positions
+def stream_positions(ref):
+  return stream_position_list(index_codec, *ref)
+
+# front coded term dictionary: the terms in sorted order, cut into blocks of
+# front_block_size terms. The first term of a block is stored in full, every
+# other one as the length of the prefix it shares with the previous term and
+# the remaining suffix, each followed by its word id; all numbers are variable
+# byte coded. A table of block offsets comes first, so lookups binary search
+# the block heads and then scan a single block.
+front_block_size = 16
+
+# variable byte code of one number as a string, high bit set on the last byte
+def vb_string(num):
+  bytes = chr(num % 128 + 128)
+  num /= 128
+  while num > 0:
+    bytes = chr(num % 128) + bytes
+    num /= 128
+  return bytes
+
+def front_code(terms, word_ids):
+  offsets = []
+  blocks = []
+  pos = 0
+  for i in range(0, len(terms), front_block_size):
+    entries = []
+    prev = ''
+    for term, word_id in zip(terms[i:i+front_block_size], word_ids[i:i+front_block_size]):
+      shared = len(os.path.commonprefix([prev, term]))
+      entries.append(vb_string(shared) + vb_string(len(term) - shared) + term[shared:] + vb_string(word_id))
+      prev = term
+    block = ''.join(entries)
+    offsets.append(pos)
+    blocks.append(block)
+    pos += len(block)
+  header = struct.pack('<III', len(terms), front_block_size, len(offsets))
+  return header + struct.pack('<%dI' % len(offsets), *offsets) + ''.join(blocks)
 
 # function to count number of files in collection
 def count_file():
@@ -127,133 +334,585 @@ def count_file():
   total_file_count += 1
   return total_file_count
 
-# function for merging two lines of postings list to create a new line of merged results
-def merge_posting (line1, line2):
-  # don't forget to return the resulting line at the end
-  ans = [line1[0]]
-  posting1 = deque(line1[1:])
-  posting2 = deque(line2[1:])
-  pp1 = popLeftOrNone(posting1)
-  pp2 = popLeftOrNone(posting2)
-  while pp1 is not None and pp2 is not None:
-    if pp1 == pp2:
-      ans.append(pp1)
-      pp1 = popLeftOrNone(posting1)
-      pp2 = popLeftOrNone(posting2)
-    elif pp1 < pp2:
-      ans.append(pp1)
-      pp1 = popLeftOrNone(posting1)
-    else:
-      ans.append(pp2)
-      pp2 = popLeftOrNone(posting2)
-  while pp1 is not None:
-    ans.append(pp1)
-    pp1 = popLeftOrNone(posting1)
-  while pp2 is not None:
-    ans.append(pp2)
-    pp2 = popLeftOrNone(posting2)
-  return ans
+# iterate over the postings lists of a block in word id order, as word id, doc
+# freq and where to find the doc ids and, if those are kept, the positions.
+# Blocks coming out of inversion still use local term ids, so their lists are
+# visited in word id order through the offsets from their lexicon and relabeled
+# on the fly
+def block_postings(block):
+  block_f = open(out_dir+'/'+block, 'rb')
+  block_f.read(header_size)
+  positions = None
+  if positional:
+    pos_f = open(out_dir+'/'+block+'.pos', 'rb')
+  if block in block_lexicon:
+    offsets, word_ids, pos_offsets = block_lexicon[block]
+    for local_id in sorted(range(len(word_ids)), key = word_ids.__getitem__):
+      block_f.seek(offsets[local_id])
+      term_id, df, docs = next_posting(block_f)
+      if positional:
+        pos_f.seek(pos_offsets[local_id])
+        positions = next_positions(pos_f, df)
+      yield word_ids[local_id], df, docs, positions
+  else:
+    while True:
+      posting = next_posting(block_f)
+      if posting is None:
+        break
+      term_id, df, docs = posting
+      if positional:
+        positions = next_positions(pos_f, df)
+      yield term_id, df, docs, positions
+  block_f.close()
+  if positional:
+    pos_f.close()
 
+# k-way merge of the blocks in 'blocks' into the new block 'comb'. The lists
+# of a term are joined by join_posting when they allow it and otherwise merged
+# as streams straight into the encoder, blocks never share a document so the
+# merged doc freq is the sum of theirs. With positions, the doc ids are
+# streamed a second time to order the positions
+def merge_blocks(blocks, comb):
+  readers = [block_postings(b) for b in blocks]
+  comb_f = OutputFile(out_dir+'/'+comb)
+  comb_f.write(pack_header(index_codec))
+  if positional:
+    comb_pos_f = OutputFile(out_dir+'/'+comb+'.pos')
 
-doc_id = -1
-word_id = 0
+  # the heap holds the next unmerged postings list of every block, keyed
+  # on word id and then on block order
+  heap = []
+  for idx, reader in enumerate(readers):
+    f = next(reader, None)
+    if f is not None:
+      heap.append((f[0], idx, f))
+  heapq.heapify(heap)
 
-for dir in sorted(os.listdir(root)):
-  print >> sys.stderr, 'processing dir: ' + dir
-  dir_name = os.path.join(root, dir)
-  block_pl_name = out_dir+'/'+dir 
-  # append block names to a queue, later used in merging
-  block_q.append(dir)
+  # write the new merged posting lists block to file 'comb_f'
+  while len(heap) != 0:
+    word_id, idx, f = heapq.heappop(heap)
+    lines = [f]
+    refill = [idx]
+    while len(heap) != 0 and heap[0][0] == word_id:
+      word_id, idx, f = heapq.heappop(heap)
+      lines.append(f)
+      refill.append(idx)
+    df = sum([l[1] for l in lines])
+    refs = [l[2] for l in lines]
+    if not join_posting(comb_f, word_id, df, refs):
+      write_posting(comb_f, word_id, df, heapq.merge(*[stream_docs(ref) for ref in refs]))
+    if positional and len(lines) == 1:
+      copy_positions(comb_pos_f, word_id, lines[0][3])
+    elif positional:
+      merged = heapq.merge(*[izip(stream_docs(l[2]), stream_positions(l[3])) for l in lines])
+      write_positions(comb_pos_f, word_id, df, (p for doc, p in merged))
+    for idx in refill:
+      f = next(readers[idx], None)
+      if f is not None:
+        heapq.heappush(heap, (f[0], idx, f))
 
-  block_pl = open(block_pl_name, 'wb')
-  term_doc_list = []
-  for f in sorted(os.listdir(dir_name)):
-    count_file()
-    file_id = os.path.join(dir, f)
-    doc_id += 1
-    doc_id_dict[file_id] = doc_id
-    fullpath = os.path.join(dir_name, f)
-    file = open(fullpath, 'r')
+  comb_f.close()
+  if positional:
+    comb_pos_f.close()
+  for b in blocks:
+    os.remove(out_dir+'/'+b)
+    if positional:
+      os.remove(out_dir+'/'+b+'.pos')
+    if b in block_lexicon:
+      os.remove(out_dir+'/'+b+'.lex')
+      del block_lexicon[b]
+
+# the positions of every document of a term, from the number of positions of
+# every posting in 'counts' and all positions of the term in one array
+def split_positions(counts, positions):
+  start = 0
+  for count in counts:
+    yield positions[start:start+count].tolist()
+    start += count
+
+# write one block, the postings lists are indexed by the block's local term
+# ids, which are numbered in first-seen order. Workers know nothing of the
+# global word ids, so the block comes with a lexicon mapping them back to terms.
+# With positions, 'counts' holds the number of positions of every posting and
+# 'positions' all positions of a term in one array
+def write_block(block, terms, postings, counts, positions):
+  print >> sys.stderr, 'print posting list to disc for block:' + block
+  # write the posting lists to the block, followed by the block's lexicon
+  # listing every term with the offset of its postings list and of its positions
+  block_pl = OutputFile(out_dir+'/'+block)
+  block_pl.write(pack_header(index_codec))
+  offsets = []
+  for k, posting in enumerate(postings):
+    offsets.append(block_pl.tell())
+    write_posting(block_pl, k, len(posting), posting)
+  block_pl.close()
+  lexicon_f = open(out_dir+'/'+block+'.lex', 'w')
+  if positional:
+    pos_f = OutputFile(out_dir+'/'+block+'.pos')
+    pos_offsets = []
+    for k in range(len(postings)):
+      pos_offsets.append(pos_f.tell())
+      write_positions(pos_f, k, len(postings[k]), split_positions(counts[k], positions[k]))
+    pos_f.close()
+    lexicon_f.writelines(['%s\t%d\t%d\n' % entry for entry in izip(terms, offsets, pos_offsets)])
+  else:
+    lexicon_f.writelines(['%s\t%d\n' % (t, o) for t, o in izip(terms, offsets)])
+  lexicon_f.close()
+  return block
+
+# invert a run of documents, 'job' is the run's number, the doc id of its first
+# document and the document names. Postings are collected per term and, once
+# the memory budget is used up, flushed as a new block at the next document
+# boundary, so blocks never share a document. Returns the names of the blocks.
+def invert_docs(job):
+  run, doc_id, docs = job
+  blocks = []
+  local_dict = {}
+  terms = []
+  postings = []
+  counts = []
+  positions = []
+  mem_used = 0
+  for file_id in docs:
+    file = open(os.path.join(root, file_id), 'r')
+    position = 0
     for line in file.readlines():
       tokens = line.strip().split()
       for token in tokens:
-        if token not in word_dict:
-          word_dict[token] = word_id
-          word_id += 1
-        term_doc_list.append( (word_dict[token], doc_id) )
-  print >> sys.stderr, 'sorting term doc list for dir:' + dir
-  # sort term doc list
-  term_doc_list = sorted(set(term_doc_list))
-  print >> sys.stderr, 'print posting list to disc for dir:' + dir
-  
-  # write the posting lists to block_pl for this current block
-  groups = groupby(term_doc_list, key = lambda x : x[0])
-  lines = [[k] + [x[1] for x in v] for k, v in groups]
-  for item in lines:
-    print_posting(block_pl, item)
-  block_pl.close()
+        if token not in local_dict:
+          local_dict[token] = len(terms)
+          terms.append(token)
+          postings.append(array('I', [doc_id]))
+          mem_used += term_cost + len(token)
+          if positional:
+            counts.append(array('I', [1]))
+            positions.append(array('I', [position]))
+            mem_used += 2 * posting_cost
+        else:
+          k = local_dict[token]
+          posting = postings[k]
+          # doc ids only grow, so a duplicate is always the last entry
+          if posting[-1] != doc_id:
+            posting.append(doc_id)
+            mem_used += posting_cost
+            if positional:
+              counts[k].append(0)
+              mem_used += posting_cost
+          if positional:
+            counts[k][-1] += 1
+            positions[k].append(position)
+            mem_used += posting_cost
+        position += 1
+    file.close()
+    doc_id += 1
+    if mem_used >= block_mem:
+      blocks.append(write_block('block+%d.%d' % (run, len(blocks)), terms, postings, counts, positions))
+      local_dict = {}
+      terms = []
+      postings = []
+      counts = []
+      positions = []
+      mem_used = 0
+  if len(terms) != 0:
+    blocks.append(write_block('block+%d.%d' % (run, len(blocks)), terms, postings, counts, positions))
+  return blocks
+
+# read a dictionary file of name and id lines into a dict name -> id
+def read_dict(path):
+  d = {}
+  dict_f = open(path, 'r')
+  for line in dict_f.read().splitlines():
+    if len(line) > 0:
+      name, id = line.split('\t')
+      d[name] = int(id)
+  dict_f.close()
+  return d
+
+# write the dictionaries in a binary format that query.py memory maps instead
+# of parsing the text files. Every file starts with a magic and an entry count,
+# all numbers are little endian. word.bin holds the front coded terms, doc.bin
+# the doc names by doc id, posting.bin the file positions (64 bit) and then the
+# doc freqs by word id
+def write_string_table(f, strings):
+  # a string table is an offsets array with one extra end offset, followed
+  # by all the strings concatenated
+  offsets = [0]
+  for s in strings:
+    offsets.append(offsets[-1] + len(s))
+  f.write(struct.pack('<%dI' % len(offsets), *offsets))
+  f.write(''.join(strings))
+
+# queries take the index in a directory for the build named in its
+# index.version. A build first marks it as 'building', writes every file under
+# a temporary name and renames it into place, corpus.index last, and only then
+# writes its own version. A query that reads the same finished version before
+# and after loading the files has loaded one whole build. Versions start with
+# the pid of the build, which tells queries whether it is still running
+def write_version(dir, version):
+  version_f = open(dir + '/index.version.tmp', 'w')
+  version_f.write(version)
+  version_f.close()
+  os.rename(dir + '/index.version.tmp', dir + '/index.version')
+
+# turn the final merged block into the index in 'dir', with the dictionaries
+# of the documents in 'docs' and the terms in 'words', both name -> id. The
+# tables by word id run up to the largest word id in 'words', terms without a
+# list in the index get zeros
+def write_index(dir, final_name, docs, words):
+  num_words = max(words.itervalues()) + 1 if len(words) > 0 else 0
+  version = '%d.%f' % (os.getpid(), time.time())
+  write_version(dir, 'building ' + version)
+
+  # the positions stream of the final block becomes corpus.positions, followed
+  # by the position of every term's positions by word id (64 bit), their count
+  # and a magic
+  if positional:
+    pos_f = open(out_dir+'/'+final_name+'.pos', 'ab')
+    pos_f.write(struct.pack('<%dQ' % num_words, *[position_dict.get(k, 0) for k in range(num_words)]))
+    pos_f.write(struct.pack('<I4s', num_words, 'POSN'))
+    pos_f.close()
+
+  # print all the dictionary files
+  doc_dict_f = open(dir + '/doc.dict.tmp', 'w')
+  word_dict_f = open(dir + '/word.dict.tmp', 'w')
+  posting_dict_f = open(dir + '/posting.dict.tmp', 'w')
+  print >> doc_dict_f, '\n'.join( ['%s\t%d' % (k,v) for (k,v) in sorted(docs.iteritems(), key=lambda(k,v):v)])
+  print >> word_dict_f, '\n'.join( ['%s\t%d' % (k,v) for (k,v) in sorted(words.iteritems(), key=lambda(k,v):v)])
+  print >> posting_dict_f, '\n'.join(['%s\t%s' % (k,'\t'.join([str(elm) for elm in v])) for (k,v) in sorted(posting_dict.iteritems(), key=lambda(k,v):v)])
+  doc_dict_f.close()
+  word_dict_f.close()
+  posting_dict_f.close()
+  names = ['doc.dict', 'word.dict', 'posting.dict']
+
+  if binary_dict:
+    terms = sorted(words.iterkeys())
+    word_bin_f = open(dir + '/word.bin.tmp', 'wb')
+    word_bin_f.write(struct.pack('<4sI', 'WFCD', len(terms)))
+    word_bin_f.write(front_code(terms, [words[t] for t in terms]))
+    word_bin_f.close()
+    del terms
+
+    doc_bin_f = open(dir + '/doc.bin.tmp', 'wb')
+    doc_bin_f.write(struct.pack('<4sI', 'DOCS', len(docs)))
+    write_string_table(doc_bin_f, [k for (k,v) in sorted(docs.iteritems(), key=lambda(k,v):v)])
+    doc_bin_f.close()
+
+    postings = [posting_dict.get(k, (0, 0)) for k in range(num_words)]
+    posting_bin_f = open(dir + '/posting.bin.tmp', 'wb')
+    posting_bin_f.write(struct.pack('<4sI', 'POST', len(postings)))
+    posting_bin_f.write(struct.pack('<%dQ' % len(postings), *[v[0] for v in postings]))
+    posting_bin_f.write(struct.pack('<%dI' % len(postings), *[v[1] for v in postings]))
+    posting_bin_f.close()
+    del postings
+    names += ['word.bin', 'doc.bin', 'posting.bin']
+  else:
+    # query.py maps the binary dicts whenever they are there, so those left
+    # by an earlier build into the same directory go
+    for name in ['word.bin', 'doc.bin', 'posting.bin']:
+      if os.path.exists(dir + '/' + name):
+        os.remove(dir + '/' + name)
+
+  # a query still reading the files of the earlier build keeps them open, as
+  # they are replaced and never rewritten
+  for name in names:
+    os.rename(dir + '/' + name + '.tmp', dir + '/' + name)
+  if positional:
+    os.rename(out_dir+'/'+final_name+'.pos', dir+'/corpus.positions')
+  elif os.path.exists(dir+'/corpus.positions'):
+    # query.py would take the positions of an earlier build into the same
+    # directory for those of this index
+    os.remove(dir+'/corpus.positions')
+
+  # rename the final merged block to corpus.index
+  os.rename(out_dir+'/'+final_name, dir+'/corpus.index')
+  write_version(dir, version)
+
+# multi-way merge of the blocks in block_q, each pass merges up to
+# merge_fan_in blocks at once into a block named 'prefix' and the pass number.
+# Fresh blocks still use local term ids, so there is always at least one pass.
+# The dicts of list positions are filled anew, blocks inverted in this process
+# left entries under local term ids. Returns the name of the final block
+def merge_all(prefix):
+  posting_dict.clear()
+  position_dict.clear()
+  merge_count = 0
+  while merge_count == 0 or len(block_q) > 1:
+    blocks = [block_q.popleft() for i in range(min(merge_fan_in, len(block_q)))]
+    print >> sys.stderr, 'merging %s' % ', '.join(blocks)
+    comb = prefix + '%d' % merge_count
+    merge_count += 1
+    merge_blocks(blocks, comb)
+    block_q.append(comb)
+  return block_q.popleft()
+
+# segments: with --segment output_dir holds several indexes instead of one,
+# each in a subdirectory seg+N with its own corpus.index and dictionaries. The
+# file 'segments' lists them in doc id order, one per line with the name, the
+# doc id of the first document and the number of documents. Every run adds a
+# segment for the new subdirectories of data_dir, doc ids and word ids go on
+# from the existing segments, so a term has the same word id in all of them.
+# Segments are never changed once listed; the list is replaced through a
+# rename, so queries always see a complete set
+def read_manifest():
+  segments = []
+  if os.path.exists(out_dir + '/segments'):
+    manifest_f = open(out_dir + '/segments', 'r')
+    for line in manifest_f.read().splitlines():
+      if len(line) > 0:
+        name, first_doc, count = line.split('\t')
+        segments.append((name, int(first_doc), int(count)))
+    manifest_f.close()
+  return segments
+
+def write_manifest(segments):
+  manifest_f = open(out_dir + '/segments.tmp', 'w')
+  for entry in segments:
+    print >> manifest_f, '%s\t%d\t%d' % entry
+  manifest_f.close()
+  os.rename(out_dir + '/segments.tmp', out_dir + '/segments')
+
+# the list is read and replaced under an exclusive lock on segments.lock, so
+# a run adding a segment and a compaction do not lose each other's changes.
+# The lock is released by closing the returned file
+def manifest_lock():
+  lock_f = open(out_dir + '/segments.lock', 'w')
+  fcntl.flock(lock_f, fcntl.LOCK_EX)
+  return lock_f
+
+# create the directory of a new segment and return its name, numbers are not
+# reused while the directory of an earlier segment is still around
+def new_segment():
+  numbers = [int(path.split('+')[-1]) for path in glob.glob(out_dir + '/seg+*')]
+  n = max(numbers) + 1 if len(numbers) > 0 else 0
+  while True:
+    try:
+      os.mkdir('%s/seg+%d' % (out_dir, n))
+      return 'seg+%d' % n
+    except OSError:
+      n += 1
+
+# tiered compaction: segments are put in size tiers by the size of their
+# corpus.index, tier 0 below tier_base bytes and every further tier
+# tier_width times larger. Whenever tier_width adjacent segments are in the
+# same tier they are merged into one segment of the next tier, like the runs
+# of a log-structured merge, which bounds the number of segments to about
+# tier_width per tier. Only adjacent segments are merged, so every segment
+# keeps a contiguous range of doc ids
+tier_base = 1024 * 1024
+
+def segment_tier(size):
+  tier = 0
+  limit = tier_base
+  while size >= limit:
+    tier += 1
+    limit *= tier_width
+  return tier
+
+# the first run of tier_width adjacent segments in the same tier as (start,
+# end), or None
+def tier_run(segments):
+  tiers = [segment_tier(os.path.getsize(out_dir + '/' + name + '/corpus.index')) for name, first_doc, count in segments]
+  for start in range(len(tiers) - tier_width + 1):
+    if len(set(tiers[start:start+tier_width])) == 1:
+      return start, start + tier_width
+  return None
+
+# merge segments until no run is left. The corpus.index files of a run are
+# merged as blocks: they use the global word ids and cover disjoint doc id
+# ranges, so their lists are mostly joined as they are stored. All work
+# happens in the directory of the new segment, and the run is replaced by it
+# in the list only once it is complete. Queries keep using the old segments
+# until they see the new list, their directories are removed by the next
+# compaction. Only one compaction runs at a time, so it can go on in the
+# background next to runs adding segments
+def compact_segments():
+  global index_codec, positional, binary_dict, num_docs
+  compact_f = open(out_dir + '/compact.lock', 'w')
+  try:
+    fcntl.flock(compact_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError:
+    print >> sys.stderr, 'compaction already running'
+    return
+  lock_f = manifest_lock()
+  segments = read_manifest()
+  listed = set([name for name, first_doc, count in segments])
+  for path in glob.glob(out_dir + '/seg+*'):
+    if os.path.basename(path) not in listed:
+      shutil.rmtree(path)
+  lock_f.close()
+
+  while True:
+    run = tier_run(segments)
+    if run is None:
+      break
+    start, end = run
+    merged = segments[start:end]
+    dirs = [out_dir + '/' + name for name, first_doc, count in merged]
+    index_f = open(dirs[0] + '/corpus.index', 'rb')
+    index_codec = unpack_header(index_f.read(header_size))
+    index_f.close()
+    positional = os.path.exists(dirs[0] + '/corpus.positions')
+    binary_dict = os.path.exists(dirs[0] + '/word.bin')
+    num_docs = merged[-1][1] + merged[-1][2]
+    name = new_segment()
+    print >> sys.stderr, 'compacting %s into %s' % (', '.join([entry[0] for entry in merged]), name)
+    for i, dir in enumerate(dirs):
+      block = '%s/block+%d' % (name, i)
+      os.link(dir + '/corpus.index', out_dir + '/' + block)
+      if positional:
+        os.link(dir + '/corpus.positions', out_dir + '/' + block + '.pos')
+      block_q.append(block)
+    final_name = merge_all(name + '/merge+')
+    docs = {}
+    words = {}
+    for dir in dirs:
+      docs.update(read_dict(dir + '/doc.dict'))
+      words.update(read_dict(dir + '/word.dict'))
+    write_index(out_dir + '/' + name, final_name, docs, words)
+
+    # segments are only added at the end while the compaction runs
+    lock_f = manifest_lock()
+    segments = read_manifest()
+    segments[start:end] = [(name, merged[0][1], sum([entry[2] for entry in merged]))]
+    write_manifest(segments)
+    lock_f.close()
+  compact_f.close()
+
+if root is None:
+  compact_segments()
+  sys.exit(0)
+
+# in append mode the dictionaries of the existing index are loaded and doc ids
+# and word ids go on from them. Only the subdirectories of data_dir that hold
+# no indexed document are inverted, and the existing corpus.index joins the
+# merge as its first block. An index keeps its codec, and with positions keeps
+# them and one without stays without. Without an existing index this is a full
+# build. A new segment loads the dictionaries of all segments the same way,
+# and keeps the list locked until it is added
+indexed_dirs = set()
+index_dirs = []
+if segment:
+  lock_f = manifest_lock()
+  if os.path.exists(out_dir + '/corpus.index'):
+    print >> sys.stderr, 'output_dir holds a single index, not segments'
+    os._exit(-1)
+  segments = read_manifest()
+  index_dirs = [out_dir + '/' + name for name, first_doc, count in segments]
+elif os.path.exists(out_dir + '/segments'):
+  # query.py reads the segments whenever they are listed, a single index
+  # built next to them would never be searched
+  print >> sys.stderr, 'output_dir holds segments, not a single index'
+  os._exit(-1)
+elif append and os.path.exists(out_dir + '/corpus.index'):
+  index_dirs = [out_dir]
+else:
+  append = False
+if len(index_dirs) > 0:
+  index_f = open(index_dirs[0] + '/corpus.index', 'rb')
+  index_codec = unpack_header(index_f.read(header_size))
+  index_f.close()
+  positional = os.path.exists(index_dirs[0] + '/corpus.positions')
+  binary_dict = os.path.exists(index_dirs[0] + '/word.bin')
+  for dir in index_dirs:
+    doc_id_dict.update(read_dict(dir + '/doc.dict'))
+    word_dict.update(read_dict(dir + '/word.dict'))
+  indexed_dirs = set([os.path.dirname(name) for name in doc_id_dict])
+old_docs = len(doc_id_dict)
+
+# doc ids are handed out here, in sorted directory and file order, so that
+# they do not depend on how the documents are scheduled over the workers
+docs = []
+for dir in sorted(os.listdir(root)):
+  if dir in indexed_dirs:
+    continue
+  print >> sys.stderr, 'processing dir: ' + dir
+  for f in sorted(os.listdir(os.path.join(root, dir))):
+    count_file()
+    file_id = os.path.join(dir, f)
+    doc_id_dict[file_id] = old_docs + len(docs)
+    docs.append(file_id)
+num_docs = old_docs + len(docs)
+
+if (append or segment) and len(docs) == 0:
+  print >> sys.stderr, 'no new documents'
+  if segment:
+    lock_f.close()
+    if compact:
+      compact_segments()
+  print total_file_count
+  sys.exit(0)
+
+# with several workers the documents are cut into contiguous runs, a few per
+# worker to even out the load, and every run is inverted on its own
+if num_workers > 1:
+  run_size = max(1, (len(docs) + num_workers * 4 - 1) / (num_workers * 4))
+  jobs = [(run, old_docs + start, docs[start:start+run_size]) for run, start in enumerate(range(0, len(docs), run_size))]
+  pool = multiprocessing.Pool(num_workers)
+  run_blocks = pool.map(invert_docs, jobs, 1)
+  pool.close()
+  pool.join()
+else:
+  run_blocks = [invert_docs((0, old_docs, docs))]
 
 print >> sys.stderr, '######\nposting list construction finished!\n##########'
 
-print >> sys.stderr, '\nMerging postings...'
+# read back the block lexicons and build the global word dict. The blocks are
+# in doc id order, so numbering their terms block by block in first-seen
+# order gives the same word ids as inverting the blocks one after another
+print >> sys.stderr, '\nBuilding word dict...'
+lexicons = []
+for block in [block for blocks in run_blocks for block in blocks]:
+  # append block names to a queue, later used in merging
+  block_q.append(block)
+  lexicon_f = open(out_dir+'/'+block+'.lex', 'r')
+  lexicon = [line.split('\t') for line in lexicon_f.readlines()]
+  lexicon_f.close()
+  lexicons.append((block, lexicon))
+  if not sorted_word_ids:
+    for entry in lexicon:
+      term = entry[0]
+      if term not in word_dict:
+        word_dict[term] = len(word_dict)
+if sorted_word_ids:
+  terms = set()
+  for block, lexicon in lexicons:
+    terms.update(entry[0] for entry in lexicon)
+  for term in sorted(terms.difference(word_dict)):
+    word_dict[term] = len(word_dict)
+for block, lexicon in lexicons:
+  offsets = [int(entry[1]) for entry in lexicon]
+  pos_offsets = None
+  if positional:
+    pos_offsets = [int(entry[2]) for entry in lexicon]
+  block_lexicon[block] = (offsets, [word_dict[entry[0]] for entry in lexicon], pos_offsets)
+del lexicons
 
-# iterative pairwise merge
-while True:
-  if len(block_q) <= 1:
-    break
-  b1 = block_q.popleft()
-  b2 = block_q.popleft()
-  print >> sys.stderr, 'merging %s and %s' % (b1, b2)
-  b1_f = open(out_dir+'/'+b1, 'r')
-  b2_f = open(out_dir+'/'+b2, 'r')
-  comb = b1+'+'+b2
-  comb_f = open(out_dir + '/'+comb, 'wb')
+# the existing index goes in under a second name, so it stays intact until
+# the merged index replaces it
+if append:
+  for name in glob.glob(out_dir+'/block+index*'):
+    os.remove(name)
+  os.link(out_dir+'/corpus.index', out_dir+'/block+index')
+  if positional:
+    os.link(out_dir+'/corpus.positions', out_dir+'/block+index.pos')
+  block_q.appendleft('block+index')
 
-  # write the new merged posting lists block to file 'comb_f'
-  f1 = read_posting(b1_f)
-  f2 = read_posting(b2_f)
-
-  while len(f1) != 0 and len(f2) != 0:
-    if f1[0] == f2[0]:
-      f = merge_posting(f1, f2)
-      print_posting(comb_f, f)
-      f1 = read_posting(b1_f)
-      f2 = read_posting(b2_f)
-    elif f1[0] < f2[0]:
-      print_posting(comb_f, f1)
-      f1 = read_posting(b1_f)
-    else:
-      print_posting(comb_f, f2)
-      f2 = read_posting(b2_f)
-
-  while len(f1) != 0:
-    print_posting(comb_f, f1)
-    f1 = read_posting(b1_f)
-  while len(f2) != 0:
-    print_posting(comb_f, f2)
-    f2 = read_posting(b2_f)
-
-  b1_f.close()
-  b2_f.close()
-  comb_f.close()
-  os.remove(out_dir+'/'+b1)
-  os.remove(out_dir+'/'+b2)
-  block_q.append(comb)
+print >> sys.stderr, '\nMerging postings...'
+final_name = merge_all('merge+')
 print >> sys.stderr, '\nPosting Lists Merging DONE!'
 
-# rename the final merged block to corpus.index
-final_name = block_q.popleft()
-os.rename(out_dir+'/'+final_name, out_dir+'/corpus.index')
-
-# print all the dictionary files
-doc_dict_f = open(out_dir + '/doc.dict', 'w')
-word_dict_f = open(out_dir + '/word.dict', 'w')
-posting_dict_f = open(out_dir + '/posting.dict', 'w')
-print >> doc_dict_f, '\n'.join( ['%s\t%d' % (k,v) for (k,v) in sorted(doc_id_dict.iteritems(), key=lambda(k,v):v)])
-print >> word_dict_f, '\n'.join( ['%s\t%d' % (k,v) for (k,v) in sorted(word_dict.iteritems(), key=lambda(k,v):v)])
-print >> posting_dict_f, '\n'.join(['%s\t%s' % (k,'\t'.join([str(elm) for elm in v])) for (k,v) in sorted(posting_dict.iteritems(), key=lambda(k,v):v)])
-doc_dict_f.close()
-word_dict_f.close()
-posting_dict_f.close()
+# a new segment holds the new documents and the terms that have a list in it,
+# and is listed once it is complete
+if segment:
+  name = new_segment()
+  words = dict([(term, word_id) for term, word_id in word_dict.iteritems() if word_id in posting_dict])
+  write_index(out_dir + '/' + name, final_name, dict([(doc, doc_id_dict[doc]) for doc in docs]), words)
+  segments.append((name, old_docs, len(docs)))
+  write_manifest(segments)
+  lock_f.close()
+  if compact:
+    compact_segments()
+else:
+  write_index(out_dir, final_name, doc_id_dict, word_dict)
 
 print total_file_count
@@ -1,114 +1,801 @@
 #!/bin/env python
-from collections import deque
+from array import array
+from collections import OrderedDict
 import os, glob, os.path
+import errno
+import mmap
+import bisect
+import heapq
+import time
+import struct
 import sys
+import getopt
+import multiprocessing
+import SocketServer
 import re
 
-if len(sys.argv) != 2:
-  print >> sys.stderr, 'usage: python query.py index_dir' 
+def usage():
+  print >> sys.stderr, 'usage: python query.py [--serve=PORT|PATH] [--workers=N] [--cache-mem=MB] [--result-cache-mem=MB] index_dir'
   os._exit(-1)
 
-# pop out postings
-def popLeftOrNone(p):
-  if len(p) > 0:
-    posting = p.popleft()
+try:
+  opts, args = getopt.gnu_getopt(sys.argv[1:], '', ['serve=', 'workers=', 'cache-mem=', 'result-cache-mem='])
+except getopt.GetoptError:
+  usage()
+if len(args) != 1:
+  usage()
+
+# answer queries over a socket instead of from stdin, a port number listens
+# on localhost, anything else is the path of a unix socket
+serve_addr = None
+# number of processes answering the queries of a server
+num_workers = multiprocessing.cpu_count()
+# memory budget in bytes of the cache of decoded posting lists, per process
+cache_mem = 64 * 1024 * 1024
+# memory budget in bytes of the cache of query results and of the cache of
+# pairwise intersections, each and per process
+result_cache_mem = 16 * 1024 * 1024
+for opt, val in opts:
+  if opt == '--serve':
+    serve_addr = val
+  elif opt == '--workers':
+    num_workers = int(val)
+  elif opt == '--cache-mem':
+    cache_mem = int(float(val) * 1024 * 1024)
+  elif opt == '--result-cache-mem':
+    result_cache_mem = int(float(val) * 1024 * 1024)
+if num_workers < 1 or cache_mem < 0 or result_cache_mem < 0:
+  usage()
+
+# least recently used cache bounded by the memory its entries take, the size
+# of every entry is given by the caller. Hits, misses and evictions are counted
+class LRUCache(object):
+  def __init__(self, budget):
+    self.budget = budget
+    self.entries = OrderedDict()
+    self.used = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.entries[key] = entry
+    self.hits += 1
+    return entry[0]
+
+  def put(self, key, value, size):
+    if size > self.budget:
+      return
+    if key in self.entries:
+      self.used -= self.entries.pop(key)[1]
+    self.entries[key] = (value, size)
+    self.used += size
+    while self.used > self.budget:
+      key, entry = self.entries.popitem(last = False)
+      self.used -= entry[1]
+      self.evictions += 1
+
+  def peek(self, key):
+    return self.entries[key][0]
+
+  def clear(self):
+    self.entries.clear()
+    self.used = 0
+
+  def stats(self):
+    return '%d hits, %d misses, %d evictions, %d entries, %d bytes' % \
+      (self.hits, self.misses, self.evictions, len(self.entries), self.used)
+
+# decoded posting lists by term id, so terms that come up again are not read
+# and decoded again. A list is charged for itself and an int per doc id
+posting_cache = LRUCache(cache_mem)
+int_size = sys.getsizeof(1 << 20)
+
+def list_size(posting):
+  return sys.getsizeof(posting) + int_size * len(posting)
+
+# doc ids of whole queries by the key of their query tree, and of the
+# intersections of two terms by their pair of word ids
+result_cache = LRUCache(result_cache_mem)
+pair_cache = LRUCache(result_cache_mem)
+
+# intersect two sorted lists of doc ids. When one list is at least
+# gallop_ratio times longer than the other, the long one is searched by
+# galloping: exponential steps from the previous match, then a binary search
+# within the last step. Otherwise both lists are walked in step.
+gallop_ratio = 8
+
+def merge_posting(postings1, postings2):
+  if len(postings1) > len(postings2):
+    postings1, postings2 = postings2, postings1
+  new_posting = []
+  n = len(postings2)
+  if n >= gallop_ratio * len(postings1):
+    lo = 0
+    for doc in postings1:
+      # postings2[lo-1] < doc, find the first entry not smaller than doc
+      bound = 1
+      while lo + bound < n and postings2[lo + bound] < doc:
+        bound *= 2
+      lo = bisect.bisect_left(postings2, doc, lo + bound / 2, min(lo + bound + 1, n))
+      if lo == n:
+        break
+      if postings2[lo] == doc:
+        new_posting.append(doc)
+        lo += 1
   else:
-    posting = None
+    i = 0
+    j = 0
+    while i < len(postings1) and j < n:
+      if postings1[i] == postings2[j]:
+        new_posting.append(postings1[i])
+        i += 1
+        j += 1
+      elif postings1[i] < postings2[j]:
+        i += 1
+      else:
+        j += 1
+  return new_posting
+
+# read only views of the binary dictionaries written by index.py --binary-dict,
+# lookups are answered straight from the memory mapped files, which behave
+# like the dicts loaded from the text files
+def map_file(path):
+  f = open(path, 'rb')
+  return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# entry count of a binary dictionary file, checking its magic on the way
+def mapped_count(mm, magic):
+  file_magic, count = struct.unpack_from('<4sI', mm, 0)
+  if file_magic != magic:
+    print >> sys.stderr, 'corrupt binary dict, expected %s' % magic
+    os._exit(-1)
+  return count
+
+# strings stored as an offsets array followed by the concatenated strings
+class MappedStrings(object):
+  def __init__(self, mm, pos, count):
+    self.mm = mm
+    self.pos = pos
+    self.data = pos + 4 * (count + 1)
+    self.count = count
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, idx):
+    start, end = struct.unpack_from('<II', self.mm, self.pos + 4 * idx)
+    return self.mm[self.data + start:self.data + end]
+
+# fixed width numbers indexed by id
+class MappedArray(object):
+  def __init__(self, mm, pos, fmt):
+    self.mm = mm
+    self.pos = pos
+    self.fmt = fmt
+    self.size = struct.calcsize(fmt)
+
+  def __getitem__(self, idx):
+    return struct.unpack_from(self.fmt, self.mm, self.pos + self.size * idx)[0]
+
+# front coded term dictionary: the terms in sorted order, cut into blocks of
+# front_block_size terms. The first term of a block is stored in full, every
+# other one as the length of the prefix it shares with the previous term and
+# the remaining suffix, each followed by its word id; all numbers are variable
+# byte coded. A table of block offsets comes first, so lookups binary search
+# the block heads and then scan a single block.
+front_block_size = 16
+
+# variable byte code of one number as a string, high bit set on the last byte
+def vb_string(num):
+  bytes = chr(num % 128 + 128)
+  num /= 128
+  while num > 0:
+    bytes = chr(num % 128) + bytes
+    num /= 128
+  return bytes
+
+def front_code(terms, word_ids):
+  offsets = []
+  blocks = []
+  pos = 0
+  for i in range(0, len(terms), front_block_size):
+    entries = []
+    prev = ''
+    for term, word_id in zip(terms[i:i+front_block_size], word_ids[i:i+front_block_size]):
+      shared = len(os.path.commonprefix([prev, term]))
+      entries.append(vb_string(shared) + vb_string(len(term) - shared) + term[shared:] + vb_string(word_id))
+      prev = term
+    block = ''.join(entries)
+    offsets.append(pos)
+    blocks.append(block)
+    pos += len(block)
+  header = struct.pack('<III', len(terms), front_block_size, len(offsets))
+  return header + struct.pack('<%dI' % len(offsets), *offsets) + ''.join(blocks)
+
+# term -> word id lookups on a front coded dictionary held in a string or in a
+# memory mapped file, starting at 'pos'
+class FrontCodedWordDict(object):
+  def __init__(self, buf, pos = 0):
+    self.buf = buf
+    self.count, self.block_size, self.num_blocks = struct.unpack_from('<III', buf, pos)
+    self.table = pos + struct.calcsize('<III')
+    self.data = self.table + 4 * self.num_blocks
+
+  def read_vb(self, pos):
+    num = 0
+    while True:
+      byte = ord(self.buf[pos])
+      pos += 1
+      if byte < 128:
+        num = 128 * num + byte
+      else:
+        return 128 * num + (byte - 128), pos
+
+  # decode the term at 'pos' given the previous term of its block, returns
+  # the term, its word id and the position of the next term
+  def read_term(self, pos, prev):
+    shared, pos = self.read_vb(pos)
+    length, pos = self.read_vb(pos)
+    term = prev[:shared] + self.buf[pos:pos+length]
+    word_id, pos = self.read_vb(pos + length)
+    return term, word_id, pos
+
+  def block_pos(self, idx):
+    return self.data + struct.unpack_from('<I', self.buf, self.table + 4 * idx)[0]
+
+  # word id of a term or -1 if the term is not in the dictionary
+  def find(self, term):
+    if self.num_blocks == 0:
+      return -1
+    # last block whose head is not greater than the term
+    lo = 0
+    hi = self.num_blocks - 1
+    while lo < hi:
+      mid = (lo + hi + 1) / 2
+      if self.read_term(self.block_pos(mid), '')[0] <= term:
+        lo = mid
+      else:
+        hi = mid - 1
+    pos = self.block_pos(lo)
+    prev = ''
+    for i in range(min(self.block_size, self.count - lo * self.block_size)):
+      prev, word_id, pos = self.read_term(pos, prev)
+      if prev == term:
+        return word_id
+      if prev > term:
+        break
+    return -1
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, term):
+    return self.find(term) >= 0
+
+  def __getitem__(self, term):
+    word_id = self.find(term)
+    if word_id < 0:
+      raise KeyError(term)
+    return word_id
+
+# file locate of all the index related files
+index_dir = args[0]
+# the version of the loaded index, queries check it against the index on disk
+# and load the index again when it has been rebuilt since, which also empties
+# all caches filled from the old one
+index_version = None
+
+# an index built with index.py --segment is a set of segments, listed in the
+# file 'segments' with the doc id of their first document and their number of
+# documents. Every segment is a complete index of its own documents, with doc
+# ids and word ids shared by all segments. A query is answered on every
+# segment and the doc names found are united. The state of a loaded segment
+# is the set of globals below, which are swapped in before it is searched; its
+# caches get an equal share of the memory budgets. A single index is one
+# segment starting at doc id 0
+segment_globals = ['index_f', 'index_mm', 'word_mm', 'word_dict', 'doc_mm', 'doc_id_dict',
+  'posting_mm', 'file_pos_dict', 'doc_freq_dict', 'first_doc', 'num_docs', 'posting_cache',
+  'result_cache', 'pair_cache']
+segments = []
+
+# the list of segments is replaced through a rename, so its stat changes with
+# every new or compacted segment. A single index goes by its index.version,
+# which index.py marks as 'building' while it replaces the files; an index
+# built before there was one goes by the stat of corpus.index
+def index_stat():
+  if os.path.exists(index_dir+'/segments'):
+    st = os.stat(index_dir+'/segments')
+  elif os.path.exists(index_dir+'/index.version'):
+    version_f = open(index_dir+'/index.version', 'r')
+    version = version_f.read()
+    version_f.close()
+    return version
+  else:
+    st = os.stat(index_dir+'/corpus.index')
+  return (st.st_ino, st.st_size, st.st_mtime)
+
+# whether the index.py run of a 'building' version, whose id starts with its
+# pid, is still running
+def builder_running(version):
+  try:
+    os.kill(int(version.split()[1].split('.')[0]), 0)
+  except (IndexError, ValueError):
+    return False
+  except OSError, e:
+    return e.errno == errno.EPERM
+  return True
+
+# load the index on disk into segments. While a build is writing a new index
+# the one loaded is kept, the first load waits for it. A build that exited
+# before finishing left its marker, the files there are loaded then. Files
+# that change while they are loaded are loaded again, so index_version is only
+# set once all of them come from the build it names
+def load_index():
+  global index_version, segments
+  while True:
+    version = index_stat()
+    if isinstance(version, str) and version.startswith('building') and builder_running(version):
+      if index_version is not None:
+        return
+      time.sleep(0.1)
+      continue
+    try:
+      loaded = load_segments()
+    except Exception:
+      # a newer build replaced the files while they were read
+      if index_stat() == version:
+        raise
+      continue
+    if index_stat() == version:
+      break
+  if isinstance(version, str) and version.startswith('building'):
+    print >> sys.stderr, 'index.py exited before finishing the index, loading the files there'
+  segments = loaded
+  index_version = version
+
+# load every segment listed in the file 'segments', or the single index,
+# returns the list of their globals
+def load_segments():
+  entries = [(index_dir, 0)]
+  if os.path.exists(index_dir+'/segments'):
+    manifest_f = open(index_dir+'/segments', 'r')
+    entries = []
+    for line in manifest_f.read().splitlines():
+      if len(line) > 0:
+        name, start, count = line.split('\t')
+        entries.append((index_dir+'/'+name, int(start)))
+    manifest_f.close()
+  loaded = []
+  for dir, start in entries:
+    load_segment(dir, start, len(entries))
+    loaded.append(dict([(name, globals()[name]) for name in segment_globals]))
+  return loaded
+
+def load_segment(dir, start, share):
+  global index_f, index_mm, word_mm, word_dict, doc_mm, doc_id_dict, posting_mm, \
+    file_pos_dict, doc_freq_dict, first_doc, num_docs, posting_cache, result_cache, \
+    pair_cache
+  index_f = open(dir+'/corpus.index', 'rb')
+  # the index is memory mapped, posting lists are sliced straight out of the
+  # mapping and the OS page cache keeps the frequently used ones in memory
+  index_mm = mmap.mmap(index_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  # doc names are looked up by their doc id minus first_doc
+  first_doc = start
+  word_mm = None
+  doc_mm = None
+  posting_mm = None
+  if os.path.exists(dir+'/word.bin'):
+    print >> sys.stderr, 'mapping binary dicts'
+    word_mm = map_file(dir+'/word.bin')
+    mapped_count(word_mm, 'WFCD')
+    word_dict = FrontCodedWordDict(word_mm, 8)
+    doc_mm = map_file(dir+'/doc.bin')
+    doc_id_dict = MappedStrings(doc_mm, 8, mapped_count(doc_mm, 'DOCS'))
+    posting_mm = map_file(dir+'/posting.bin')
+    term_count = mapped_count(posting_mm, 'POST')
+    file_pos_dict = MappedArray(posting_mm, 8, '<Q')
+    doc_freq_dict = MappedArray(posting_mm, 8 + 8 * term_count, '<I')
+  else:
+    word_dict_f = open(dir+'/word.dict', 'r')
+    doc_dict_f = open(dir+'/doc.dict', 'r')
+    posting_dict_f = open(dir+'/posting.dict', 'r')
+
+    doc_id_dict = {}
+
+    # terms go into a front coded dictionary and the file positions and doc
+    # freqs into arrays indexed by word id, instead of hash maps. The word ids
+    # of a segment need not be contiguous, the arrays run up to the largest
+    print >> sys.stderr, 'loading word dict'
+    terms = []
+    for line in word_dict_f.readlines():
+      parts = line.split('\t')
+      terms.append((parts[0], int(parts[1])))
+    terms.sort()
+    word_dict = FrontCodedWordDict(front_code([t for t, i in terms], [i for t, i in terms]))
+    num_words = max([i for t, i in terms]) + 1 if len(terms) > 0 else 0
+    del terms
+    print >> sys.stderr, 'loading doc dict'
+    for line in doc_dict_f.readlines():
+      parts = line.split('\t')
+      doc_id_dict[int(parts[1]) - first_doc] = parts[0]
+    print >> sys.stderr, 'loading index'
+    file_pos_dict = array('L', [0]) * num_words
+    doc_freq_dict = array('I', [0]) * num_words
+    for line in posting_dict_f.readlines():
+      parts = line.split('\t')
+      term_id = int(parts[0])
+      file_pos = int(parts[1])
+      doc_freq = int(parts[2])
+      file_pos_dict[term_id] = file_pos
+      doc_freq_dict[term_id] = doc_freq
+
+  # number of documents in the segment, NOT is taken against all of them
+  num_docs = len(doc_id_dict)
+  posting_cache = LRUCache(cache_mem / share)
+  result_cache = LRUCache(result_cache_mem / share)
+  pair_cache = LRUCache(result_cache_mem / share)
+
+load_index()
+
+def read_posting(term_id):
+  posting = posting_cache.get(term_id)
+  if posting is None:
+    posting = load_posting(term_id)
+    posting_cache.put(term_id, posting, list_size(posting))
   return posting
 
-def merge_posting (postings1, postings2):
+def load_posting(term_id):
+  # posting list lookup for a given term, the line starts at its file position
+  # in the mapped index and runs up to the next newline
+  global index_mm, file_pos_dict
+  pos = file_pos_dict[term_id]
+  line = index_mm[pos:index_mm.find('\n', pos)]
+  return [int(u) for u in line.split('\t')[2].split()]
+
+# skip table of the posting line of a term: the doc ids preceding each segment
+# and the offsets at which the segments start, both including the first
+# segment, together with the position and length of the doc ids field
+def read_skips(term_id):
+  pos = index_mm.find('\t', file_pos_dict[term_id]) + 1
+  end = index_mm.find('\t', pos)
+  bases = [0]
+  offsets = [0]
+  for skip in index_mm[pos:end].split():
+    base, offset = skip.split(':')
+    bases.append(int(base))
+    offsets.append(int(offset))
+  return bases, offsets, end + 1, index_mm.find('\n', end) - end - 1
+
+# intersect the sorted doc ids in 'result' with the posting list of a term.
+# A list that is in the posting cache is merged as it is.
+# When the list has more segments than there are doc ids left in the result,
+# its skip pointers are followed and only the segments that may hold one of
+# the doc ids are parsed, otherwise the whole list is read and merged
+def intersect_posting(result, term_id):
+  if term_id in posting_cache:
+    return merge_posting(result, read_posting(term_id))
+  bases, offsets, pos, length = read_skips(term_id)
+  if len(bases) <= len(result):
+    return merge_posting(result, read_posting(term_id))
+  ends = offsets[1:] + [length]
   new_posting = []
-  pp1 = popLeftOrNone(postings1);
-  pp2 = popLeftOrNone(postings2);
-  while  pp1 is not None and pp2 is not None:
-    if pp1 == pp2:
-      new_posting.append(pp1)
-      pp1 = popLeftOrNone(postings1)
-      pp2 = popLeftOrNone(postings2)
-    elif pp1 < pp2:
-      pp1 = popLeftOrNone(postings1)
+  seg = -1
+  for doc in result:
+    # segment k holds the doc ids after bases[k] up to bases[k+1]
+    k = bisect.bisect_left(bases, doc, 1) - 1
+    if k != seg:
+      seg = k
+      seg_docs = set([int(u) for u in index_mm[pos + offsets[k]:pos + ends[k]].split()])
+    if doc in seg_docs:
+      new_posting.append(doc)
+  return new_posting
+
+# boolean queries: terms combined with AND, OR, NOT and parentheses, terms
+# next to each other are ANDed. NOT binds tightest, then AND, then OR. A query
+# is parsed into a tree of ('term', word_id, df), ('and', children), ('or',
+# children) and ('not', child) nodes, unseen terms have a doc freq of 0
+class QueryError(Exception):
+  pass
+
+query_ops = ('AND', 'OR', 'NOT')
+
+def parse_query(input):
+  tokens = re.findall(r'[()]|[^\s()]+', input)
+  node, pos = parse_or(tokens, 0)
+  if pos != len(tokens):
+    raise QueryError('unexpected ' + tokens[pos])
+  return node
+
+def parse_or(tokens, pos):
+  node, pos = parse_and(tokens, pos)
+  children = [node]
+  while pos < len(tokens) and tokens[pos] == 'OR':
+    node, pos = parse_and(tokens, pos + 1)
+    children.append(node)
+  return join_nodes('or', children), pos
+
+def parse_and(tokens, pos):
+  node, pos = parse_not(tokens, pos)
+  children = [node]
+  while pos < len(tokens) and tokens[pos] not in ('OR', ')'):
+    if tokens[pos] == 'AND':
+      pos += 1
+    node, pos = parse_not(tokens, pos)
+    children.append(node)
+  return join_nodes('and', children), pos
+
+def parse_not(tokens, pos):
+  if pos == len(tokens):
+    raise QueryError('unexpected end of query')
+  token = tokens[pos]
+  if token == 'NOT':
+    node, pos = parse_not(tokens, pos + 1)
+    if node[0] == 'not':
+      return node[1], pos
+    return ('not', node), pos
+  if token == '(':
+    node, pos = parse_or(tokens, pos + 1)
+    if pos == len(tokens) or tokens[pos] != ')':
+      raise QueryError('missing )')
+    return node, pos + 1
+  if token in query_ops or token == ')':
+    raise QueryError('unexpected ' + token)
+  if token not in word_dict:
+    return ('term', -1, 0), pos + 1
+  word_id = word_dict[token]
+  return ('term', word_id, doc_freq_dict[word_id]), pos + 1
+
+# a single child stands for itself, nested nodes of the same kind are flattened
+def join_nodes(kind, children):
+  if len(children) == 1:
+    return children[0]
+  flat = []
+  for child in children:
+    if child[0] == kind:
+      flat.extend(child[1])
     else:
-      pp2 = popLeftOrNone(postings2)
-  return deque(new_posting)
+      flat.append(child)
+  return (kind, flat)
 
-# file locate of all the index related files
-index_dir = sys.argv[1]
-index_f = open(index_dir+'/corpus.index', 'r')
-word_dict_f = open(index_dir+'/word.dict', 'r')
-doc_dict_f = open(index_dir+'/doc.dict', 'r')
-posting_dict_f = open(index_dir+'/posting.dict', 'r')
-
-word_dict = {}
-doc_id_dict = {}
-file_pos_dict = {}
-doc_freq_dict = {}
-
-print >> sys.stderr, 'loading word dict'
-for line in word_dict_f.readlines():
-  parts = line.split('\t')
-  word_dict[parts[0]] = int(parts[1])
-print >> sys.stderr, 'loading doc dict'
-for line in doc_dict_f.readlines():
-  parts = line.split('\t')
-  doc_id_dict[int(parts[1])] = parts[0]
-print >> sys.stderr, 'loading index'
-for line in posting_dict_f.readlines():
-  parts = line.split('\t')
-  term_id = int(parts[0])
-  file_pos = int(parts[1])
-  doc_freq = int(parts[2])
-  file_pos_dict[term_id] = file_pos
-  doc_freq_dict[term_id] = doc_freq
+# planner estimate of the number of doc ids a subtree evaluates to: the doc
+# freq of a term, the smallest estimate of the children of an AND, the sum
+# over the children of an OR and all other documents for a NOT
+def estimate(node):
+  kind = node[0]
+  if kind == 'term':
+    return node[2]
+  if kind == 'not':
+    return num_docs - estimate(node[1])
+  if kind == 'or':
+    return min(num_docs, sum([estimate(child) for child in node[1]]))
+  return min([estimate(child) for child in node[1]])
 
-def read_posting(term_id):
-  # provide implementation for posting list lookup for a given term
-  # a useful function to use is index_f.seek(file_pos), which does a disc seek to 
-  # a position offset 'file_pos' from the beginning of the file
-  global index_f, file_pos_dict
-  index_f.seek(file_pos_dict[term_id])
-  line = index_f.readline().strip()
-  return deque([int(u) for u in line.split()[1:]])
+# whether a subtree certainly evaluates to no doc ids: a term no document
+# holds, an AND with such a child or an OR whose children all are. A NOT
+# never is. Estimates only order the work, the estimate of a NOT can be lower
+# than its result
+def is_empty(node):
+  kind = node[0]
+  if kind == 'term':
+    return node[2] == 0
+  if kind == 'not':
+    return False
+  if kind == 'or':
+    return all([is_empty(child) for child in node[1]])
+  return any([is_empty(child) for child in node[1]])
 
-# read query from stdin
-while True:
-  input = sys.stdin.readline()
-  input = input.strip()
-  if len(input) == 0: # end of file reached
-    break
-  input_parts = input.split()
-  # you need to translate words into word_ids
-  # don't forget to handle the case where query contains unseen words
-  # next retrieve the postings list of each query term, and merge the posting lists
-  # to produce the final result
-  query = []
-  flag = False
-  for item in input_parts:
-    if item not in word_dict:
-      print "no results found"
-      flag = True
-      break
+# doc ids of postings1 that are not in postings2, both sorted
+def difference_posting(postings1, postings2):
+  new_posting = []
+  n = len(postings2)
+  j = 0
+  for doc in postings1:
+    if n >= gallop_ratio * len(postings1):
+      j = bisect.bisect_left(postings2, doc, j)
     else:
-      query.append((word_dict[item], doc_freq_dict[word_dict[item]]))
+      while j < n and postings2[j] < doc:
+        j += 1
+    if j == n or postings2[j] != doc:
+      new_posting.append(doc)
+  return new_posting
 
-  if flag:
-    continue
+# k-way union of sorted lists of doc ids
+def union_postings(postings):
+  new_posting = []
+  for doc in heapq.merge(*postings):
+    if len(new_posting) == 0 or doc != new_posting[-1]:
+      new_posting.append(doc)
+  return new_posting
+
+# pairs of terms are keyed by their word ids in order
+def pair_key(word_id1, word_id2):
+  return (min(word_id1, word_id2), max(word_id1, word_id2))
+
+# the key of the cached pair of two distinct terms with the fewest doc ids,
+# None if no pair of the terms is cached
+def cached_pair(query):
+  pairs = []
+  for i in range(len(query)):
+    for j in range(i + 1, len(query)):
+      key = pair_key(query[i][0], query[j][0])
+      if query[i][0] != query[j][0] and key in pair_cache:
+        pairs.append(key)
+  if len(pairs) == 0:
+    return None
+  return min(pairs, key = lambda key: len(pair_cache.peek(key)))
 
-  query.sort(key = lambda x:x[1], reverse=False)
+# cache key of a query tree, the same for trees that only differ in the order
+# or repetition of the children of an AND or OR
+def query_key(node):
+  kind = node[0]
+  if kind == 'term':
+    return node[1]
+  if kind == 'not':
+    return ('not', query_key(node[1]))
+  return (kind, tuple(sorted(set([query_key(child) for child in node[1]]))))
+
+# AND of terms given as (word id, doc freq): intersect rarest first, every
+# list only with the running result, and stop as soon as nothing is left
+def intersect_terms(query):
+  query = sorted(query, key = lambda x:x[1])
+  # start from the smallest cached intersection of two of the terms
+  pair = cached_pair(query)
+  if pair is not None:
+    result = pair_cache.get(pair)
+    for word_id, df in query:
+      if len(result) == 0:
+        break
+      if word_id not in pair:
+        result = intersect_posting(result, word_id)
+    return result
   result = read_posting(query[0][0])
   for idx in range(1, len(query)):
-    result = merge_posting(result, read_posting(query[idx][0]))
+    if len(result) == 0:
+      break
+    result = intersect_posting(result, query[idx][0])
+    if idx == 1 and query[0][0] != query[1][0]:
+      pair_cache.put(pair_key(query[0][0], query[1][0]), result, list_size(result))
+  return result
 
-  if len(result) == 0:
-    print "no results found"
+# evaluate a query tree into sorted doc ids. The children of an AND are
+# intersected rarest first, with terms going through intersect_posting, and
+# its NOT children are subtracted afterwards with difference merges, largest
+# first. The children of an OR are united in one k-way merge. Subtrees that
+# are certainly empty are never read, and a NOT that is not under an AND is
+# evaluated against all documents
+def evaluate(node):
+  kind = node[0]
+  if kind == 'term':
+    if node[2] == 0:
+      return []
+    return read_posting(node[1])
+  if kind == 'or':
+    return union_postings([evaluate(child) for child in node[1] if not is_empty(child)])
+  if kind == 'not':
+    return difference_posting(range(first_doc, first_doc + num_docs), evaluate(node[1]))
+  positive = sorted([child for child in node[1] if child[0] != 'not'], key = estimate)
+  negative = sorted([child[1] for child in node[1] if child[0] == 'not'], key = estimate, reverse = True)
+  if len(positive) == 0:
+    result = range(first_doc, first_doc + num_docs)
+  elif is_empty(node):
+    return []
+  elif all([child[0] == 'term' for child in positive]):
+    result = intersect_terms([(child[1], child[2]) for child in positive])
   else:
-    doc_name = []
+    result = None
+    for child in positive:
+      if child[0] == 'term' and result is not None:
+        result = intersect_posting(result, child[1])
+      elif result is None:
+        result = evaluate(child)
+      else:
+        result = merge_posting(result, evaluate(child))
+      if len(result) == 0:
+        return result
+  for child in negative:
+    if len(result) == 0:
+      break
+    if not is_empty(child):
+      result = difference_posting(result, evaluate(child))
+  return result
+
+# answer one query, returns the lines to print for it
+def answer(input):
+  # you need to translate words into word_ids
+  # don't forget to handle the case where query contains unseen words
+  # next retrieve the postings list of each query term, and merge the posting lists
+  # to produce the final result
+  if index_stat() != index_version:
+    load_index()
+  doc_name = []
+  for segment in segments:
+    globals().update(segment)
+    try:
+      query = parse_query(input)
+    except QueryError, e:
+      print >> sys.stderr, 'invalid query: %s' % e
+      return ["no results found"]
+
+    if query[0] == 'term':
+      # a single list is kept by the posting cache
+      result = evaluate(query)
+    else:
+      key = query_key(query)
+      result = result_cache.get(key)
+      if result is None:
+        result = evaluate(query)
+        result_cache.put(key, result, list_size(result))
+
+    # don't forget to convert doc_id back to doc_name, and sort in lexicographical order
+    # before printing out to stdout
     for i in result:
-      doc_name.append(doc_id_dict[i])
-    doc_name.sort()
-    for item in doc_name:
-      print item
+      doc_name.append(doc_id_dict[i - first_doc])
+  if len(doc_name) == 0:
+    return ["no results found"]
+  doc_name.sort()
+  return doc_name
+
+# server mode: a client sends queries one per line and gets back the lines
+# query.py would print for each of them, followed by an empty line. Every
+# connection is served by its own thread and the queries are answered by a
+# pool of worker processes, forked once the index is loaded so that they all
+# share its mappings
+class QueryHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    while True:
+      input = self.rfile.readline()
+      if len(input) == 0:
+        break
+      input = input.strip()
+      lines = []
+      if len(input) != 0:
+        lines = pool.apply(answer, (input,))
+      self.wfile.write(''.join([line + '\n' for line in lines]) + '\n')
 
-  # posting = read_posting(word_id)
+class TCPQueryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class UnixQueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+if serve_addr is not None:
+  pool = multiprocessing.Pool(num_workers)
+  if serve_addr.isdigit():
+    server = TCPQueryServer(('127.0.0.1', int(serve_addr)), QueryHandler)
+  else:
+    if os.path.exists(serve_addr):
+      os.remove(serve_addr)
+    server = UnixQueryServer(serve_addr, QueryHandler)
+  print >> sys.stderr, 'serving queries on %s' % serve_addr
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  if not serve_addr.isdigit():
+    os.remove(serve_addr)
+  pool.terminate()
+  os._exit(0)
 
-  # don't forget to convert doc_id back to doc_name, and sort in lexicographical order
-  # before printing out to stdout
+# read query from stdin
+while True:
+  input = sys.stdin.readline()
+  input = input.strip()
+  if len(input) == 0: # end of file reached
+    break
+  for line in answer(input):
+    print line
+for segment in segments:
+  print >> sys.stderr, 'posting cache: ' + segment['posting_cache'].stats()
+  print >> sys.stderr, 'result cache: ' + segment['result_cache'].stats()
+  print >> sys.stderr, 'pair cache: ' + segment['pair_cache'].stats()
@@ -1,4 +1,4 @@
 #!/bin/bash
 #Get directory of this file
 SCRIPTPATH=$( cd $(dirname $0) ; pwd -P )
-python $SCRIPTPATH/index.py $1 $2
+python $SCRIPTPATH/index.py "$@"
@@ -0,0 +1,121 @@
+# helpers of the tests, which run the index and query scripts of every task
+# under Python 2, named by $PYTHON2, on small corpora written to a temporary
+# directory. The tests run under Python 2 or 3 with python -m pytest or python
+# -m unittest discover tests from the repository root
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+python2 = os.environ.get('PYTHON2', sys.executable if sys.version_info[0] == 2 else 'python2')
+tasks = ['task1', 'task2', 'extra_credit']
+# the tasks whose indexes can hold positions and roaring bitmaps
+positional_tasks = ['task2', 'extra_credit']
+codec_names = ['vb', 'gamma', 'delta', 'rice', 'pfor', 'simple8b']
+
+def have_python2():
+  try:
+    return subprocess.call([python2, '-c', 'pass'], stderr=open(os.devnull, 'w')) == 0
+  except OSError:
+    return False
+
+needs_python2 = unittest.skipUnless(have_python2(), 'needs Python 2')
+
+# a corpus of 'dirs' subdirectories of 'docs' documents each, drawn from a
+# vocabulary of 'words' terms with a few very common ones, so that indexes
+# get inline, gaps and bitmap lists. The same seed gives the same corpus
+def random_corpus(dirs, docs, words = 60, seed = 0):
+  rng = random.Random(seed)
+  vocab = ['w%d' % i for i in range(words)]
+  weights = [1.0 / (i + 1) for i in range(words)]
+  total = sum(weights)
+  corpus = {}
+  for d in range(dirs):
+    for n in range(docs):
+      text = []
+      for i in range(rng.randint(3, 20)):
+        x = rng.random() * total
+        k = 0
+        while x > weights[k] and k < words - 1:
+          x -= weights[k]
+          k += 1
+        text.append(vocab[k])
+      corpus['%d/doc%03d' % (d, n)] = ' '.join(text)
+  return corpus
+
+# queries over the terms of random_corpus mixing every operator
+def random_queries(count = 60, words = 60, seed = 1):
+  rng = random.Random(seed)
+  term = lambda: 'w%d' % rng.randint(0, words + 4)
+  shapes = [
+    lambda: term(),
+    lambda: '%s AND %s' % (term(), term()),
+    lambda: '%s %s %s' % (term(), term(), term()),
+    lambda: '%s OR %s' % (term(), term()),
+    lambda: '%s AND NOT %s' % (term(), term()),
+    lambda: 'NOT %s' % term(),
+    lambda: '(%s OR %s) AND (%s OR NOT %s)' % (term(), term(), term(), term()),
+  ]
+  return [rng.choice(shapes)() for i in range(count)]
+
+# run the Python 2 source 'script' with the source directory of 'task' on its
+# path and 'input' on its standard input, returns its standard output
+def run_python2(task, script, input = ''):
+  proc = subprocess.Popen([python2, '-c', script, os.path.join(root, task)],
+    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = proc.communicate(input.encode())
+  if proc.returncode != 0:
+    raise AssertionError(err.decode())
+  return out.decode()
+
+class ScriptTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def path(self, *names):
+    return os.path.join(self.tmp, *names)
+
+  # write the documents of 'corpus', 'subdir/name' -> text, below 'data_dir'
+  def write_corpus(self, data_dir, corpus):
+    for name, text in corpus.items():
+      path = os.path.join(self.path(data_dir), name)
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      f = open(path, 'w')
+      f.write(text + '\n')
+      f.close()
+
+  # run index.py of 'task', returns its exit code and standard error
+  def run_index(self, task, args):
+    proc = subprocess.Popen([python2, os.path.join(root, task, 'index.py')] + args,
+      stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+    err = proc.communicate()[1]
+    return proc.returncode, err.decode()
+
+  def build(self, task, data_dir, index_dir, *opts):
+    code, err = self.run_index(task, list(opts) + [self.path(data_dir), self.path(index_dir)])
+    self.assertEqual(code, 0, err)
+
+  # run query.py of 'task' on 'queries', returns the lines it prints for all
+  # of them and its standard error. A run taking longer than 'timeout'
+  # seconds is killed and fails the test
+  def run_query(self, task, index_dir, queries, timeout = 60):
+    proc = subprocess.Popen([python2, os.path.join(root, task, 'query.py'), self.path(index_dir)],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    out, err = proc.communicate(''.join([query + '\n' for query in queries]).encode())
+    timer.cancel()
+    self.assertEqual(proc.returncode, 0, err)
+    return out.decode().split(), err.decode()
+
+  def answers(self, task, index_dir, query):
+    return self.run_query(task, index_dir, [query])[0]
@@ -0,0 +1,89 @@
+# tests of the posting list codecs of extra_credit/codec.py. The module is
+# Python 2, so the lists go through a Python 2 process as JSON and come back
+# decoded
+import json
+import random
+import unittest
+
+from support import ScriptTest, codec_names, needs_python2, random_corpus, random_queries, run_python2
+
+# encodes and decodes every (codec, gaps) pair read from stdin
+round_trip_script = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import codec
+out = []
+for name, gaps in json.load(sys.stdin):
+  encode, decode = codec.codecs[name]
+  out.append(decode(bytearray(encode(gaps)), len(gaps)))
+json.dump(out, sys.stdout)
+'''
+
+header_script = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import codec
+out = [codec.unpack_header(codec.pack_header(name)) for name in sorted(codec.codecs)]
+for buf in [codec.pack_header('lz4'), 'XIDX' + codec.pack_header('vb')[4:]]:
+  try:
+    codec.unpack_header(buf)
+    out.append('accepted')
+  except ValueError:
+    out.append('rejected')
+json.dump(out, sys.stdout)
+'''
+
+def gap_lists():
+  rng = random.Random(2)
+  lists = [
+    [],
+    [0],
+    [1],
+    [5],
+    [2 ** 28],
+    [1] * 3,
+    [1] * 300,
+    # whole pfor blocks and simple8b words, without a tail
+    [1] * 128,
+    [1] * 256,
+    [1] * 240,
+    [3] * 120,
+    # tails of a single number
+    [1] * 129,
+    [7] * 241,
+    # exceptions: a few gaps far wider than the rest of their block
+    [1] * 60 + [2 ** 28] + [1] * 60,
+    [2] * 127 + [2 ** 28 + 1],
+    [2 ** 28 + i for i in range(5)],
+    [2 ** 30, 1, 2 ** 31, 1, 2 ** 40],
+    [rng.choice([1, 2, 3, 2 ** 20, 2 ** 29]) for i in range(500)],
+  ]
+  for n in [2, 17, 130, 1000]:
+    lists.append([rng.randint(1, 2 ** rng.randint(1, 16)) for i in range(n)])
+  return lists
+
+@needs_python2
+class CodecTest(ScriptTest):
+  def test_round_trip(self):
+    cases = [(name, gaps) for name in codec_names for gaps in gap_lists()]
+    decoded = json.loads(run_python2('extra_credit', round_trip_script, json.dumps(cases)))
+    for (name, gaps), result in zip(cases, decoded):
+      self.assertEqual(result, gaps, '%s of %d gaps' % (name, len(gaps)))
+
+  def test_header(self):
+    result = json.loads(run_python2('extra_credit', header_script))
+    self.assertEqual(result, sorted(codec_names) + ['rejected', 'rejected'])
+
+  # every codec gives the answers of the default codec, on a corpus with
+  # gaps lists long enough for skip pointers
+  def test_build_with_every_codec(self):
+    self.write_corpus('data', random_corpus(4, 100, 200))
+    queries = random_queries(120, 200)
+    self.build('extra_credit', 'data', 'default')
+    expected = self.run_query('extra_credit', 'default', queries)[0]
+    for name in codec_names:
+      self.build('extra_credit', 'data', name, '--codec=' + name, '--workers=2')
+      self.assertEqual(self.run_query('extra_credit', name, queries)[0], expected, name)
+
+if __name__ == '__main__':
+  unittest.main()
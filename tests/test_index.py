@@ -0,0 +1,101 @@
+# tests of index.py runs that build on an existing output_dir: --append,
+# --segment and --compact must give the answers of one full build
+import os
+import unittest
+
+from support import ScriptTest, needs_python2, random_corpus, random_queries, tasks
+
+corpus = random_corpus(4, 25)
+queries = random_queries()
+
+def subdirs(first, last):
+  return dict([(name, text) for name, text in corpus.items() if first <= int(name.split('/')[0]) < last])
+
+# the files of an index that depend on its documents only
+index_files = ['corpus.index', 'doc.dict', 'word.dict', 'posting.dict', 'word.bin', 'doc.bin', 'posting.bin']
+
+@needs_python2
+class AppendTest(ScriptTest):
+  def read_file(self, path):
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+  # an index built from the first subdirectories and then appended to, two
+  # subdirectories at a time, is the index of a full build. Whether it has
+  # binary dicts is up to the index, not to the options of the appends
+  def check_append(self, task, first_opts, append_opts):
+    name = '%s%s.append%s' % (task, ''.join(first_opts), ''.join(append_opts))
+    self.write_corpus(name + '.full.data', corpus)
+    self.build(task, name + '.full.data', name + '.full', *first_opts)
+    data = name + '.data'
+    self.write_corpus(data, subdirs(0, 1))
+    self.build(task, data, name, *first_opts)
+    for d in [1, 3]:
+      self.write_corpus(data, subdirs(d, d + 2))
+      self.build(task, data, name, *(['--append'] + append_opts))
+    for f in index_files:
+      full = self.path(name + '.full', f)
+      self.assertEqual(os.path.exists(self.path(name, f)), os.path.exists(full), f)
+      if os.path.exists(full):
+        self.assertEqual(self.read_file(self.path(name, f)), self.read_file(full), f)
+    self.assertEqual(self.run_query(task, name, queries)[0], self.run_query(task, name + '.full', queries)[0])
+    return name
+
+  def test_append(self):
+    for task in tasks:
+      self.check_append(task, [], [])
+
+  def test_append_keeps_binary_dicts(self):
+    for task in tasks:
+      name = self.check_append(task, ['--binary-dict'], [])
+      self.assertTrue(os.path.exists(self.path(name, 'word.bin')))
+      name = self.check_append(task, [], ['--binary-dict'])
+      self.assertFalse(os.path.exists(self.path(name, 'word.bin')))
+
+@needs_python2
+class SegmentTest(ScriptTest):
+  def read_manifest(self, index_dir):
+    f = open(self.path(index_dir, 'segments'))
+    lines = f.read().splitlines()
+    f.close()
+    return [line.split('\t') for line in lines if len(line) > 0]
+
+  def test_segments_and_compaction(self):
+    self.write_corpus('full', corpus)
+    for task in tasks:
+      self.build(task, 'full', task + '.full')
+      expected = self.run_query(task, task + '.full', queries)[0]
+      data = task + '.data'
+      for d in range(4):
+        self.write_corpus(data, subdirs(d, d + 1))
+        self.build(task, data, task, '--segment')
+      self.assertEqual([int(count) for name, start, count in self.read_manifest(task)], [25] * 4)
+      self.assertEqual(self.run_query(task, task, queries)[0], expected)
+
+      code, err = self.run_index(task, ['--compact', '--tier-width=2', self.path(task)])
+      self.assertEqual(code, 0, err)
+      manifest = self.read_manifest(task)
+      self.assertTrue(len(manifest) < 4)
+      self.assertEqual(sum([int(count) for name, start, count in manifest]), 100)
+      self.assertEqual(self.run_query(task, task, queries)[0], expected)
+
+  def test_segments_and_single_index_do_not_mix(self):
+    self.write_corpus('data', subdirs(0, 2))
+    for task in tasks:
+      self.build(task, 'data', task + '.seg', '--segment')
+      for opts in [[], ['--append']]:
+        code, err = self.run_index(task, opts + [self.path('data'), self.path(task + '.seg')])
+        self.assertNotEqual(code, 0)
+        self.assertTrue('holds segments' in err, err)
+      self.assertFalse(os.path.exists(self.path(task + '.seg', 'corpus.index')))
+
+      self.build(task, 'data', task + '.single')
+      code, err = self.run_index(task, ['--segment', self.path('data'), self.path(task + '.single')])
+      self.assertNotEqual(code, 0)
+      self.assertTrue('holds a single index' in err, err)
+      self.assertFalse(os.path.exists(self.path(task + '.single', 'segments')))
+
+if __name__ == '__main__':
+  unittest.main()
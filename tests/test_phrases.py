@@ -0,0 +1,68 @@
+# tests of phrase and NEAR/k queries on indexes built with --positions, which
+# only task2 and extra_credit have
+import os
+import unittest
+
+from support import ScriptTest, needs_python2, positional_tasks
+
+corpus = {
+  '0/d0': 'new york city',
+  '0/d1': 'york new city',
+  '0/d2': 'new jersey york',
+  '0/d3': 'city of new york',
+  '0/d4': 'a b c d e f',
+  '0/d5': 'f e',
+}
+
+no_results = ['no', 'results', 'found']
+
+# query -> answer
+answers = {
+  '"new york"': ['0/d0', '0/d3'],
+  '"new york city"': ['0/d0'],
+  '"york new"': ['0/d1'],
+  '"new york" AND NOT "york city"': ['0/d3'],
+  '"new york" OR "jersey york"': ['0/d0', '0/d2', '0/d3'],
+  '"york"': ['0/d0', '0/d1', '0/d2', '0/d3'],
+  # NEAR/k matches terms at most k positions apart, in either order
+  'a NEAR/5 f': ['0/d4'],
+  'a NEAR/4 f': no_results,
+  'f NEAR/1 e': ['0/d4', '0/d5'],
+  'new NEAR/1 york': ['0/d0', '0/d1', '0/d3'],
+  'new NEAR/2 york': ['0/d0', '0/d1', '0/d2', '0/d3'],
+  'new NEAR/2 york AND NOT "new york"': ['0/d1', '0/d2'],
+  # terms no document holds
+  '"new zzz"': no_results,
+  '"zzz new york"': no_results,
+  'a NEAR/3 zzz': no_results,
+  '"zzz yyy" OR a': ['0/d4'],
+}
+
+@needs_python2
+class PhraseTest(ScriptTest):
+  def setUp(self):
+    ScriptTest.setUp(self)
+    self.write_corpus('data', corpus)
+
+  def test_phrase_and_near(self):
+    for task in positional_tasks:
+      self.build(task, 'data', task, '--positions')
+      for query, expected in sorted(answers.items()):
+        self.assertEqual(self.answers(task, task, query), expected, '%s: %s' % (task, query))
+
+  # a build without --positions into the directory of one with them leaves no
+  # positions behind, phrase queries then report the missing positions
+  def test_rebuild_without_positions(self):
+    for task in positional_tasks:
+      self.build(task, 'data', task, '--positions')
+      self.assertTrue(os.path.exists(self.path(task, 'corpus.positions')))
+      self.build(task, 'data', task)
+      self.assertFalse(os.path.exists(self.path(task, 'corpus.positions')))
+      for query in ['"new york"', 'a NEAR/5 f']:
+        out, err = self.run_query(task, task, [query])
+        self.assertEqual(out, no_results)
+        self.assertTrue('the index has no positions' in err, err)
+      self.assertEqual(self.answers(task, task, 'new york'), ['0/d0', '0/d1', '0/d2', '0/d3'])
+
+if __name__ == '__main__':
+  unittest.main()
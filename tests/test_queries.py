@@ -0,0 +1,65 @@
+# regression tests of query.py, run with python -m pytest or python -m
+# unittest from the repository root. The index and query scripts of every
+# task are run under Python 2, named by $PYTHON2, on a small corpus generated
+# in a temporary directory
+import subprocess
+import time
+import unittest
+
+from support import ScriptTest, needs_python2, python2, tasks
+
+# the doc freqs of a, b and c add up to more than the number of documents,
+# so an estimate taken as a count leaves nothing for NOT (a OR b OR c)
+corpus = {'0/d0': 'a b', '0/d1': 'a c', '0/d2': 'b c', '0/d3': 'd'}
+
+@needs_python2
+class QueryTest(ScriptTest):
+  def setUp(self):
+    ScriptTest.setUp(self)
+    self.write_corpus('data', corpus)
+
+  def test_or_over_not_or(self):
+    for task in tasks:
+      self.build(task, 'data', task)
+      self.assertEqual(self.answers(task, task, 'NOT (a OR b OR c)'), ['0/d3'])
+      self.assertEqual(self.answers(task, task, 'zzz OR NOT (a OR b OR c)'), ['0/d3'])
+      self.assertEqual(self.answers(task, task, '(NOT (a OR b OR c) OR zzz) AND NOT zzz'), ['0/d3'])
+      self.assertEqual(self.answers(task, task, 'a AND zzz'), ['no', 'results', 'found'])
+
+  # index.py marks index.version as building while it replaces the files of
+  # an index, and writes the version of the index when it is done
+  def mark_building(self, index_dir, pid):
+    f = open(self.path(index_dir, 'index.version'), 'w')
+    f.write('building %d.0' % pid)
+    f.close()
+
+  def test_unfinished_build(self):
+    for task in tasks:
+      self.build(task, 'data', task)
+      path = self.path(task, 'index.version')
+      f = open(path)
+      version = f.read()
+      f.close()
+
+      # a build that was killed leaves its marker, the files there are loaded
+      proc = subprocess.Popen([python2, '-c', 'pass'])
+      proc.wait()
+      self.mark_building(task, proc.pid)
+      out, err = self.run_query(task, task, ['d'], timeout = 10)
+      self.assertEqual(out, ['0/d3'])
+      self.assertTrue('exited before finishing' in err, err)
+
+      # a running build is waited for
+      finish = 'import os, time; time.sleep(1); f = open(%r, "w"); f.write(%r); f.close(); os.rename(%r, %r)' % \
+        (path + '.tmp', version, path + '.tmp', path)
+      proc = subprocess.Popen([python2, '-c', finish])
+      self.mark_building(task, proc.pid)
+      start = time.time()
+      out, err = self.run_query(task, task, ['d'], timeout = 10)
+      proc.wait()
+      self.assertTrue(time.time() - start >= 0.5)
+      self.assertEqual(out, ['0/d3'])
+      self.assertFalse('exited before finishing' in err, err)
+
+if __name__ == '__main__':
+  unittest.main()